@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from cricbuzz import Cricbuzz
+from logger import Logger
+
+
+class MatchCatalog:
+    """
+    Holds the current matches from cricbuzz, fetched once per cycle and shared
+    between the fetch loops
+    """
+
+    def __init__(self, cb: Cricbuzz, max_age: float) -> None:
+        self.cb = cb
+        self.max_age = max_age
+        self._matches = {}
+        self._refreshed_at = None
+        # Archived matches are never downloaded again, their payload is kept
+        self._archived = set()
+        self.version = 0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> None:
+        """
+        Discovers the current match ids and downloads every match once. A failed
+        discovery keeps the catalog as it is, and a match which could not be
+        downloaded keeps its previous payload
+        """
+        listed_ids = await self.cb.fetch_current_macth_id()
+        if listed_ids is None:
+            Logger.log_error("Match discovery failed, keeping the previous catalog")
+            return
+
+        ids = [int(match_id) for match_id in listed_ids]
+        self.cb.retain_matches(ids)
+        self._archived &= set(ids)
+        previous = self._matches
+        fetch_ids = [
+            match_id
+            for match_id in ids
+            if match_id not in self._archived or match_id not in previous
+        ]
+        matches = await asyncio.gather(*[self.cb.fetch_match(i) for i in fetch_ids])
+        fetched = dict(zip(fetch_ids, matches))
+
+        self._matches = {}
+        for match_id in ids:
+            match = fetched.get(match_id) or previous.get(match_id)
+            if match:
+                self._matches[match_id] = match
+        self._refreshed_at = time.monotonic()
+        self.version += 1
+        Logger.log_info(f"Catalog refreshed with {len(self._matches)} matches")
+
+    def mark_archived(self, match_ids: set) -> None:
+        """
+        Records matches which are archived, so later refreshes keep their payload
+        instead of downloading them
+        """
+        self._archived |= set(match_ids)
+
+    def match_ids(self) -> set:
+        """
+        Returns the ids of all the matches in the catalog
+        """
+        return set(self._matches)
+
+    async def matches_in_state(self, state: str) -> dict:
+        """
+        Returns the matches in the given state, refreshing the catalog if it is stale
+        """
+        async with self._lock:
+            if self._is_stale():
+                await self.refresh()
+
+        return {
+            match_id: match
+            for match_id, match in self._matches.items()
+            if match["matchHeader"]["state"] == state
+        }
+
+    def _is_stale(self) -> bool:
+        """
+        Checks if the catalog is older than the allowed age
+        """
+        if self._refreshed_at is None:
+            return True
+        return time.monotonic() - self._refreshed_at >= self.max_age
@@ -0,0 +1,59 @@
+from codec import Codec
+from database import Database
+
+
+class CommentaryCheckpoint:
+    """
+    Records how far the commentary backfill of a match got for each innings, and
+    stores every page as soon as it is fetched, so a restart resumes the walk
+    instead of starting over. The writes run off the event loop
+    """
+
+    def __init__(self, mongodb: Database, match_id: int) -> None:
+        self.mongodb = mongodb
+        self.match_id = match_id
+        # (innings id, timestamp) of the entries already stored by the checkpoint
+        self.saved = set()
+
+    async def start(self, innings_ids: list, head_timestamp: int) -> None:
+        """
+        Records the innings which are about to be walked from the head timestamp
+        """
+        for innings_id in innings_ids:
+            await Codec.run_offloaded(
+                self.mongodb.save_checkpoint,
+                self.match_id,
+                innings_id,
+                head_timestamp,
+                False,
+            )
+
+    async def save_page(
+        self, innings_id: int, entries: list, cursor: int, complete: bool
+    ) -> None:
+        """
+        Stores the entries of a page and moves the cursor of the innings
+        """
+        await Codec.run_offloaded(
+            self.mongodb.write_commentary_entries, self.match_id, entries
+        )
+        await Codec.run_offloaded(
+            self.mongodb.save_checkpoint, self.match_id, innings_id, cursor, complete
+        )
+        self.saved.update((c.get("inningsId"), c["timestamp"]) for c in entries)
+
+    def unsaved(self, commentary: list) -> list:
+        """
+        Returns the entries which were not stored by the checkpoint
+        """
+        return [
+            comment
+            for comment in commentary
+            if (comment.get("inningsId"), comment["timestamp"]) not in self.saved
+        ]
+
+    async def finish(self) -> None:
+        """
+        Removes the checkpoints once the backfill is complete
+        """
+        await Codec.run_offloaded(self.mongodb.delete_checkpoints, self.match_id)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import constants
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+class Codec:
+    """
+    Decodes json payloads with orjson when installed, moving large payloads off
+    the event loop
+    """
+
+    __executor = None
+
+    @classmethod
+    def _get_executor(cls) -> Executor:
+        """
+        Returns the pool used for large payloads, creating it on first use
+        """
+        if cls.__executor is None:
+            if constants.CODEC_OFFLOAD_EXECUTOR == "process":
+                cls.__executor = ProcessPoolExecutor(constants.CODEC_OFFLOAD_WORKERS)
+            else:
+                cls.__executor = ThreadPoolExecutor(constants.CODEC_OFFLOAD_WORKERS)
+        return cls.__executor
+
+    @classmethod
+    async def decode(cls, data: bytes):
+        """
+        Decodes a json payload, in the pool if it is above the offload threshold
+        """
+        if len(data) < constants.CODEC_OFFLOAD_THRESHOLD:
+            return _loads(data)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls._get_executor(), _loads, data)
+
+    @classmethod
+    async def run_offloaded(cls, func, *args):
+        """
+        Runs a blocking function in a worker thread, used for encoding and writing
+        large batches to the database
+        """
+        return await asyncio.to_thread(func, *args)
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Shuts the pool down
+        """
+        if cls.__executor is not None:
+            cls.__executor.shutdown(wait=False)
+            cls.__executor = None
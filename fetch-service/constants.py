@@ -7,10 +7,94 @@ CB_MATCH_BASE_URL = "https://www.cricbuzz.com/api/cricket-match/commentary"
 CB_COMMENTARY_PAGINATION_BASE_URL = (
     "https://www.cricbuzz.com/api/cricket-match/commentary-pagination"
 )
+CB_LIVE_SCORES_URL = "https://www.cricbuzz.com/live-cricket-scores"
+CB_REQUEST_TIMEOUT = 10
+CB_CONNECTION_POOL_SIZE = 20
+CB_KEEPALIVE_TIMEOUT = 30
+CB_MAX_CONCURRENT_REQUESTS = 10
+# Requests per second allowed for each endpoint
+CB_RATE_LIMITS = {"scores": 0.5, "match": 10, "pagination": 10}
+CB_RATE_LIMIT_BURST = 10
+CB_MAX_RETRIES = 3
+CB_RETRY_BASE_DELAY = 1
+CB_RETRY_MAX_DELAY = 30
+CB_BREAKER_FAILURE_THRESHOLD = 10
+CB_BREAKER_COOLDOWN = 60
+# Innings paginated concurrently during a commentary backfill
+CB_BACKFILL_MAX_INNINGS_CONCURRENCY = 4
 
 # Fetcher
 GAME_COMPLETED_FETCH_SLEEP = 1800
 GAME_UPDATE_FETCH_SLEEP = 5
+# Live match polling, the interval grows with the time since the last new ball
+MATCH_DISCOVERY_INTERVAL = 60
+MATCH_POLL_MAX_INTERVAL = 30
+MATCH_POLL_IDLE_FACTOR = 0.25
+MATCH_BREAK_POLL_INTERVAL = 120
+# Matches in these states never change again and are archived once fetched
+MATCH_ARCHIVE_STATES = ("Complete",)
+
+# Database
+MONGO_MAX_POOL_SIZE = 10
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+# "ball" stores one document per commentary entry, "array" one document per match
+COMMENTARY_STORAGE_MODE = "ball"
+COMMENTARY_ENTRIES_COLLECTION = "commentary_entries"
+# Commentary of finished matches, as gzip compressed chunks of BSON documents
+COMMENTARY_ARCHIVE_COLLECTION = "commentary_archive"
+ARCHIVE_CHUNK_ENTRIES = 1000
+
+# Codec, payloads above these sizes are decoded or written off the event loop
+CODEC_OFFLOAD_THRESHOLD = 256 * 1024
+CODEC_OFFLOAD_ENTRIES = 500
+# "thread" or "process"
+CODEC_OFFLOAD_EXECUTOR = "thread"
+CODEC_OFFLOAD_WORKERS = 2
+
+# Storage projection, only these fields of the matches and commentary are stored
+STORE_PROJECTED = True
+MATCH_PROJECTION = [
+    "matchHeader.matchId",
+    "matchHeader.state",
+    "matchHeader.status",
+    "matchHeader.matchDescription",
+    "matchHeader.matchFormat",
+    "matchHeader.matchType",
+    "matchHeader.seriesName",
+    "matchHeader.team1.name",
+    "matchHeader.team1.shortName",
+    "matchHeader.team2.name",
+    "matchHeader.team2.shortName",
+    "matchHeader.tossResults.tossWinnerName",
+    "matchHeader.tossResults.decision",
+]
+COMMENTARY_PROJECTION = [
+    "commText",
+    "timestamp",
+    "ballNbr",
+    "overNumber",
+    "inningsId",
+    "batTeamName",
+    "batTeamScore",
+    "event",
+    "commentaryFormats",
+]
+# Also keep the full cricbuzz payload of every match in the raw_matches collection
+STORE_RAW_MATCHES = False
+
+# Leases, a match is owned by one fetcher instance at a time
+LEASE_TTL = 30
+LEASE_RENEW_INTERVAL = 10
+
+# Seconds the in-flight work may take to finish after SIGTERM
+SHUTDOWN_DRAIN_TIMEOUT = 20
+
+# Metrics
+METRICS_LOG_INTERVAL = 300
 
 # Logger
+LOG_LEVEL = "DEBUG"
 LOG_FILE = "fetcher-service.log"
+# Write one json object per log line instead of plain text
+LOG_JSON = False
@@ -1,9 +1,26 @@
+import asyncio
+import hashlib
+import itertools
+import random
 import re
 
-import requests
+import aiohttp
 
 import constants
+from checkpoint import CommentaryCheckpoint
+from codec import Codec
 from logger import Logger
+from metrics import Metrics
+from resilience import CircuitBreaker, TokenBucket
+
+# Statuses which are worth retrying after a pause
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CricbuzzError(Exception):
+    """
+    Raised when cricbuzz keeps failing a request after all the retries
+    """
 
 
 class Cricbuzz:
@@ -12,40 +29,197 @@ class Cricbuzz:
     """
 
     def __init__(self) -> None:
-        pass
+        self._session = None
+        self._semaphore = None
+        # match id -> (etag, last modified, body digest, decoded match)
+        self._match_cache = {}
+        self._limiters = {
+            endpoint: TokenBucket(rate, constants.CB_RATE_LIMIT_BURST)
+            for endpoint, rate in constants.CB_RATE_LIMITS.items()
+        }
+        self._breaker = CircuitBreaker(
+            "cricbuzz",
+            constants.CB_BREAKER_FAILURE_THRESHOLD,
+            constants.CB_BREAKER_COOLDOWN,
+        )
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the shared client session, creating it on first use
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=constants.CB_CONNECTION_POOL_SIZE,
+                keepalive_timeout=constants.CB_KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(total=constants.CB_REQUEST_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(constants.CB_MAX_CONCURRENT_REQUESTS)
+        return self._session
+
+    def is_degraded(self) -> bool:
+        """
+        Checks if requests to cricbuzz are paused by the circuit breaker
+        """
+        return self._breaker.is_open()
+
+    async def _get(self, url: str, endpoint: str, headers: dict = None) -> tuple:
+        """
+        Performs a rate limited GET request with retries and returns the status code,
+        the headers and the body
+        """
+        session = await self._get_session()
+        for attempt in range(constants.CB_MAX_RETRIES + 1):
+            self._breaker.check()
+            await self._limiters[endpoint].acquire()
+            Metrics.increment(f"cricbuzz.{endpoint}.requests")
 
-    def fetch_current_macth_id(self) -> set:
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with session.get(url, headers=headers) as res:
+                        status, res_headers = res.status, res.headers
+                        body = await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if status not in RETRYABLE_STATUSES:
+                    self._breaker.record_success()
+                    return status, res_headers, body
+                error = f"status {status}"
+                retry_after = res_headers.get("Retry-After")
+
+            Metrics.increment(f"cricbuzz.{endpoint}.failures")
+            self._breaker.record_failure()
+            if attempt == constants.CB_MAX_RETRIES:
+                break
+
+            delay = self._backoff_delay(attempt, retry_after)
+            Logger.log_info("Retrying %s in %.1fs after %s", url, delay, error)
+            Metrics.increment(f"cricbuzz.{endpoint}.retries")
+            await asyncio.sleep(delay)
+
+        raise CricbuzzError(f"Request to {url} failed after retries: {error}")
+
+    def _backoff_delay(self, attempt: int, retry_after: str = None) -> float:
         """
-        Fetches the current avaible match ids from cricbuzz
+        Returns the pause before the next attempt, honouring Retry-After if sent
+        """
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), constants.CB_RETRY_MAX_DELAY)
+        # Full jitter exponential backoff
+        delay = min(
+            constants.CB_RETRY_BASE_DELAY * 2**attempt, constants.CB_RETRY_MAX_DELAY
+        )
+        return random.uniform(0, delay)
+
+    async def _get_json(self, url: str, endpoint: str) -> dict:
+        """
+        Performs a GET request and returns the decoded json body, or None on a
+        non 200 status
+        """
+        status, _, body = await self._get(url, endpoint)
+        if status != 200:
+            return None
+        return await Codec.decode(body)
+
+    async def close(self) -> None:
+        """
+        Closes the client session
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def fetch_current_macth_id(self) -> set:
+        """
+        Fetches the current avaible match ids from cricbuzz, returns None if the
+        scores page could not be fetched
         """
         try:
-            res = requests.get("https://www.cricbuzz.com/live-cricket-scores")
-            text = res.text
+            status, _, body = await self._get(constants.CB_LIVE_SCORES_URL, "scores")
+            if status != 200:
+                Logger.log_error(f"Error fetching match ids: status {status}")
+                return None
+            text = body.decode("utf-8", errors="replace")
             pattern = r"/live-cricket-scores/(\d+)/"
             matches = re.findall(pattern, text)
             ids = set(matches)
             return ids
         except Exception as e:
             Logger.log_error(f"Error fetching match ids: {e}")
-            return set()
+            return None
 
-    def fetch_match(self, match_id: int) -> dict:
+    async def fetch_match(self, match_id: int) -> dict:
         """
-        Fetches a match from cricbuzz
+        Fetches a match from cricbuzz without recording it as seen, so the next call
+        to fetch_match_changes still reports what changed
+        """
+        match, _ = await self.fetch_match_changes(match_id, remember=False)
+        return match
+
+    async def fetch_match_changes(self, match_id: int, remember: bool = True) -> tuple:
+        """
+        Fetches a match from cricbuzz using conditional requests, returns the match
+        and whether it changed since the last remembered fetch
         """
         try:
-            res = requests.get(f"{constants.CB_MATCH_BASE_URL}/{match_id}")
-            data = {}
-            if res.status_code == 200:
-                data = res.json()
-            return data
+            headers = {}
+            cached = self._match_cache.get(int(match_id))
+            if cached:
+                etag, last_modified, _, _ = cached
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+            status, res_headers, body = await self._get(
+                f"{constants.CB_MATCH_BASE_URL}/{match_id}", "match", headers
+            )
+            if status == 304 and cached:
+                return cached[3], False
+            if status != 200:
+                return {}, False
+
+            # Servers without validators still return the same body when nothing moved
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            if cached and cached[2] == digest:
+                return cached[3], False
+
+            data = await Codec.decode(body)
+            if not remember:
+                return data, True
+            self._match_cache[int(match_id)] = (
+                res_headers.get("ETag"),
+                res_headers.get("Last-Modified"),
+                digest,
+                data,
+            )
+            return data, True
         except Exception as e:
             Logger.log_error(f"Error fetching match {match_id}: {e}")
-            return {}
+            return {}, False
+
+    def forget_matches(self, match_ids: set) -> None:
+        """
+        Drops the cached payloads of the given matches, so their next fetch reports
+        them as changed
+        """
+        for match_id in match_ids:
+            self._match_cache.pop(int(match_id), None)
 
-    def fetch_commentary(self, match: dict) -> list:
+    def retain_matches(self, match_ids: set) -> None:
         """
-        Fetches the commentary of a match from cricbuzz
+        Drops the cached payloads of matches which are no longer listed
+        """
+        for match_id in set(self._match_cache) - {int(i) for i in match_ids}:
+            del self._match_cache[match_id]
+
+    async def fetch_commentary(
+        self, match: dict, checkpoint: CommentaryCheckpoint = None
+    ) -> list:
+        """
+        Fetches the commentary of a match from cricbuzz, returns None if it could not
+        be fetched completely. Pages are saved to the checkpoint as they arrive
         """
         try:
             commentary = []
@@ -53,28 +227,162 @@ class Cricbuzz:
             match_id = match["matchHeader"]["matchId"]
             commentary.extend(match["commentaryList"])
 
-            self._traverse_commentary(match_id, commentary)
-            return commentary
+            if not any("inningsId" in comment for comment in commentary):
+                return commentary
+            return await self._traverse_innings_parallel(
+                match_id, commentary, checkpoint
+            )
         except Exception as e:
             Logger.log_error(
                 f"Error fetching commentary for match {match['matchHeader']['matchId']}: {e}"
             )
-            return []
+            return None
 
-    def _traverse_commentary(self, match_id: int, commentary: list) -> None:
+    async def resume_commentary(
+        self, match_id: int, cursors: dict, checkpoint: CommentaryCheckpoint
+    ) -> bool:
         """
-        Traverses the commentary of a match using the timestamps
+        Resumes the backfill of the given innings from their saved cursors, returns
+        whether every innings was walked to its first entry
         """
         try:
-            while "inningsId" in commentary[-1]:
-                innings_id = commentary[-1]["inningsId"]
-                time_stamp = commentary[-1]["timestamp"]
-                res = requests.get(
-                    f"{constants.CB_COMMENTARY_PAGINATION_BASE_URL}/{match_id}/{innings_id}/{time_stamp}"
+            await self._walk_innings(match_id, cursors, checkpoint)
+            return True
+        except Exception as e:
+            Logger.log_error(f"Error resuming commentary for match {match_id}: {e}")
+            return False
+
+    async def _walk_innings(
+        self, match_id: int, cursors: dict, checkpoint: CommentaryCheckpoint = None
+    ) -> list:
+        """
+        Walks the pagination of the given innings concurrently, each from its own
+        cursor, returns the entries of each innings
+        """
+        semaphore = asyncio.Semaphore(constants.CB_BACKFILL_MAX_INNINGS_CONCURRENCY)
+
+        async def walk(innings_id: int) -> list:
+            async with semaphore:
+                return await self._traverse_innings(
+                    match_id, innings_id, cursors[innings_id], checkpoint
+                )
+
+        return await asyncio.gather(*[walk(innings_id) for innings_id in cursors])
+
+    async def _traverse_innings_parallel(
+        self, match_id: int, commentary: list, checkpoint: CommentaryCheckpoint = None
+    ) -> list:
+        """
+        Walks the pagination of every innings concurrently from the latest timestamp
+        and merges the pages newest first
+        """
+        head_innings = {c["inningsId"] for c in commentary if "inningsId" in c}
+        head_timestamp = max(c["timestamp"] for c in commentary)
+        innings_ids = range(1, max(head_innings) + 1)
+
+        if checkpoint is not None:
+            await checkpoint.start(list(innings_ids), head_timestamp)
+        chains = await self._walk_innings(
+            match_id,
+            {innings_id: head_timestamp for innings_id in innings_ids},
+            checkpoint,
+        )
+
+        # An innings without any page means the heads could not be discovered,
+        # fall back to following the cursor across innings
+        for innings_id, chain in zip(innings_ids, chains):
+            if not chain and innings_id not in head_innings:
+                Logger.log_info(
+                    f"No pages for innings {innings_id} of match {match_id}, "
+                    "falling back to sequential traversal"
                 )
-                if res.status_code == 200:
-                    data = res.json()
-                    commentary.extend(data["commentaryList"])
+                await self._traverse_commentary(match_id, commentary)
+                return commentary
+
+        merged = {}
+        for comment in itertools.chain(commentary, *chains):
+            merged[(comment.get("inningsId"), comment["timestamp"])] = comment
+        return sorted(merged.values(), key=lambda c: c["timestamp"], reverse=True)
+
+    async def _traverse_innings(
+        self,
+        match_id: int,
+        innings_id: int,
+        time_stamp: int,
+        checkpoint: CommentaryCheckpoint = None,
+    ) -> list:
+        """
+        Follows the pagination of a single innings back to its first entry
+        """
+        entries = []
+        while True:
+            url = f"{constants.CB_COMMENTARY_PAGINATION_BASE_URL}/{match_id}/{innings_id}/{time_stamp}"
+            data = await self._get_json(url, "pagination")
+            if data is None:
+                raise CricbuzzError(f"Commentary page {url} is not available")
+
+            page = data["commentaryList"]
+            # Entries without an innings are the pre match commentary
+            innings_page = [
+                c for c in page if c.get("inningsId", innings_id) == innings_id
+            ]
+            entries.extend(innings_page)
+            complete = not page or page[-1].get("inningsId") != innings_id
+            if page:
+                time_stamp = page[-1]["timestamp"]
+            if checkpoint is not None:
+                await checkpoint.save_page(
+                    innings_id, innings_page, time_stamp, complete
+                )
+            if complete:
+                return entries
+
+    async def fetch_commentary_since(self, match: dict, watermarks: dict) -> list:
+        """
+        Fetches only the commentary newer than the stored timestamp of each innings,
+        returns None if it could not be fetched completely
+        """
+        try:
+            commentary = []
+
+            match_id = match["matchHeader"]["matchId"]
+            commentary.extend(match["commentaryList"])
+
+            if commentary:
+                await self._traverse_commentary(match_id, commentary, watermarks)
+            return [
+                comment
+                for comment in commentary
+                if not self._is_stored(comment, watermarks)
+            ]
         except Exception as e:
-            Logger.log_error(f"Error traversing commentary for match {match_id}: {e}")
-            return
+            Logger.log_error(
+                f"Error fetching new commentary for match {match['matchHeader']['matchId']}: {e}"
+            )
+            return None
+
+    def _is_stored(self, comment: dict, watermarks: dict) -> bool:
+        """
+        Checks if a commentary entry is not newer than the stored timestamp of its innings
+        """
+        return comment["timestamp"] <= watermarks.get(comment.get("inningsId"), -1)
+
+    async def _traverse_commentary(
+        self, match_id: int, commentary: list, watermarks: dict = None
+    ) -> None:
+        """
+        Traverses the commentary of a match using the timestamps, stopping at the
+        watermarks if given. Raises if a page cannot be fetched
+        """
+        while "inningsId" in commentary[-1]:
+            if watermarks is not None and self._is_stored(commentary[-1], watermarks):
+                break
+            innings_id = commentary[-1]["inningsId"]
+            time_stamp = commentary[-1]["timestamp"]
+            url = f"{constants.CB_COMMENTARY_PAGINATION_BASE_URL}/{match_id}/{innings_id}/{time_stamp}"
+            data = await self._get_json(url, "pagination")
+            if data is None:
+                raise CricbuzzError(f"Commentary page {url} is not available")
+            if not data["commentaryList"]:
+                break
+            commentary.extend(data["commentaryList"])
@@ -1,5 +1,16 @@
+import gzip
+import hashlib
+import itertools
+import json
+from datetime import datetime, timedelta, timezone
+
+import bson
+import constants
 from environment import Environment
 from logger import Logger
+from projection import Projection
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
@@ -11,13 +22,82 @@ class Database:
     Handles all the database operations
     """
 
+    _instance = None
+    __client = None
+
+    @classmethod
+    def get_instance(cls) -> "Database":
+        """
+        Returns the Database instance shared by every module of the service
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def get_client(cls) -> MongoClient:
+        """
+        Returns the MongoClient shared by the service, creating it on first use
+        """
+        if cls.__client is None:
+            cls.__client = MongoClient(
+                env.get_mongo_uri(),
+                server_api=ServerApi("1"),
+                maxPoolSize=constants.MONGO_MAX_POOL_SIZE,
+                serverSelectionTimeoutMS=constants.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=constants.MONGO_CONNECT_TIMEOUT_MS,
+            )
+        return cls.__client
+
+    @property
+    def client(self) -> MongoClient:
+        """
+        Returns the shared client
+        """
+        return Database.get_client()
+
+    @property
+    def db(self):
+        """
+        Returns the cricbuzz database of the shared client
+        """
+        return self.client["cricbuzz"]
+
     def __init__(self):
+        # The client connects on first use, indexes are created by prepare()
+        self.ball_storage = constants.COMMENTARY_STORAGE_MODE == "ball"
+        self.match_projection = Projection(constants.MATCH_PROJECTION)
+        self.commentary_projection = Projection(constants.COMMENTARY_PROJECTION)
+        # match id -> digest of each top level field last written
+        self._match_field_hashes = {}
+
+    def prepare(self) -> None:
+        """
+        Creates the indexes the service relies on, called once at startup
+        """
+        if self.ball_storage:
+            self.create_commentary_indexes()
+
+    def create_commentary_indexes(self) -> None:
+        """
+        Creates the indexes of the ball level commentary collection
+        """
         try:
-            self.uri = env.get_mongo_uri()
-            self.client = MongoClient(self.uri, server_api=ServerApi("1"))
-            self.db = self.client["cricbuzz"]
+            entries = self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+            entries.create_index(
+                [
+                    ("matchId", ASCENDING),
+                    ("inningsId", ASCENDING),
+                    ("timestamp", ASCENDING),
+                ],
+                unique=True,
+            )
+            entries.create_index([("matchId", ASCENDING), ("timestamp", ASCENDING)])
+            self.db[constants.COMMENTARY_ARCHIVE_COLLECTION].create_index(
+                [("matchId", ASCENDING), ("seq", ASCENDING)]
+            )
         except Exception as e:
-            Logger.log_error(f"Error connecting to the database: {e}")
+            Logger.log_error(f"Error creating commentary indexes: {e}")
             raise e
 
     def check_match_exists(self, match_id: int) -> dict:
@@ -30,57 +110,469 @@ class Database:
             Logger.log_error(f"Error checking if match exists: {e}")
             raise e
 
-    def upsert_match(self, match: dict) -> None:
+    def upsert_match(self, match: dict, batch: "WriteBatch") -> None:
         """
-        Inserts a match into the database
+        Queues the upsert of a match in the write batch
         """
         try:
             match_id = match["matchHeader"]["matchId"]
+            if constants.STORE_RAW_MATCHES:
+                batch.raw_operations.append(
+                    UpdateOne({"_id": match_id}, {"$set": match}, upsert=True)
+                )
+            if constants.STORE_PROJECTED:
+                match = self.match_projection.apply(match)
             match["_id"] = match_id
-            match["fullCommentaryExists"] = False
-            self.db.matches.update_one({"_id": match_id}, {"$set": match}, upsert=True)
+
+            # Only write the top level fields which changed since the last write
+            field_hashes = {
+                field: self._field_hash(value) for field, value in match.items()
+            }
+            previous_hashes = self._match_field_hashes.get(match_id, {})
+            changed = {
+                field: match[field]
+                for field, field_hash in field_hashes.items()
+                if field != "_id" and previous_hashes.get(field) != field_hash
+            }
+            if not changed:
+                Logger.log_info("Match %s is unchanged, skipping write", match_id)
+                return
+
+            update = batch.match_update(match_id)
+            update["$set"].update(changed)
+            update["$setOnInsert"].setdefault("fullCommentaryExists", False)
+            batch.field_hashes[match_id] = field_hashes
         except Exception as e:
             Logger.log_error(f"Error inserting match into the database: {e}")
             raise e
 
-    def update_commentary(self, match_id: int, commentary: list) -> None:
+    def fetch_full_commentary_flags(self, match_ids: list) -> dict:
+        """
+        Fetches the fullCommentaryExists flag of the given matches which are stored.
+        The flag only counts once the match is archived, so matches flagged during
+        a pause keep collecting commentary
+        """
+        try:
+            matches = self.db.matches.find(
+                {"_id": {"$in": match_ids}}, {"fullCommentaryExists": 1, "archived": 1}
+            )
+            return {
+                match["_id"]: match.get("fullCommentaryExists", False)
+                and match.get("archived", False)
+                for match in matches
+            }
+        except Exception as e:
+            Logger.log_error(f"Error fetching full commentary flags: {e}")
+            raise e
+
+    def fetch_archived_match_ids(self, match_ids: list) -> set:
+        """
+        Fetches the ids of the given matches whose commentary is already archived
+        """
+        try:
+            archived_matches = self.db.matches.find(
+                {"_id": {"$in": match_ids}, "commentaryArchived": True}, {"_id": 1}
+            )
+            return {match["_id"] for match in archived_matches}
+        except Exception as e:
+            Logger.log_error(f"Error fetching archived match IDs: {e}")
+            raise e
+
+    def fetch_pending_archive_ids(self, match_ids: list) -> set:
+        """
+        Fetches the ids of the given matches which are marked archived but whose
+        commentary was not moved to the archive yet
+        """
+        try:
+            pending_matches = self.db.matches.find(
+                {
+                    "_id": {"$in": match_ids},
+                    "archived": True,
+                    "commentaryArchived": {"$ne": True},
+                },
+                {"_id": 1},
+            )
+            return {match["_id"] for match in pending_matches}
+        except Exception as e:
+            Logger.log_error(f"Error fetching pending archive match IDs: {e}")
+            raise e
+
+    def fetch_commentary_watermarks(self, match_ids: list) -> dict:
         """
-        Updates commentary of a match in the database
+        Fetches the highest stored commentary timestamp of each innings of the given
+        matches, keyed by match id and then innings id
         """
-        session = self.client.start_session()
         try:
-            with session.start_transaction():
-                # Update the commentary
-                self.db.commentaries.update_one(
+            if self.ball_storage:
+                collection = self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+                pipeline = [
+                    {"$match": {"matchId": {"$in": match_ids}}},
+                    {
+                        "$group": {
+                            "_id": {"matchId": "$matchId", "inningsId": "$inningsId"},
+                            "timestamp": {"$max": "$timestamp"},
+                        }
+                    },
+                ]
+            else:
+                collection = self.db.commentaries
+                pipeline = [
+                    {"$match": {"_id": {"$in": match_ids}}},
+                    {"$unwind": "$commentary"},
+                    {
+                        "$group": {
+                            "_id": {
+                                "matchId": "$_id",
+                                "inningsId": "$commentary.inningsId",
+                            },
+                            "timestamp": {"$max": "$commentary.timestamp"},
+                        }
+                    },
+                ]
+
+            watermarks = {}
+            for innings in collection.aggregate(pipeline):
+                match_watermarks = watermarks.setdefault(innings["_id"]["matchId"], {})
+                match_watermarks[innings["_id"].get("inningsId")] = innings["timestamp"]
+            return watermarks
+        except Exception as e:
+            Logger.log_error(f"Error fetching commentary watermarks: {e}")
+            raise e
+
+    def update_commentary(
+        self, match_id: int, commentary: list, batch: "WriteBatch"
+    ) -> None:
+        """
+        Queues the replacement of the commentary of a match in the write batch
+        """
+        commentary = self._project_commentary(commentary)
+        if self.ball_storage:
+            self._upsert_commentary_entries(match_id, commentary, batch)
+        else:
+            batch.commentary_operations.append(
+                UpdateOne(
                     {"_id": match_id},
                     {"$set": {"commentary": commentary}},
-                    session=session,
                     upsert=True,
                 )
+            )
+
+    def append_commentary(
+        self, match_id: int, commentary: list, batch: "WriteBatch"
+    ) -> None:
+        """
+        Queues the new commentary entries of a match in the write batch
+        """
+        commentary = self._project_commentary(commentary)
+        if self.ball_storage:
+            self._upsert_commentary_entries(match_id, commentary, batch)
+        elif commentary:
+            # Stored commentary is newest first
+            batch.commentary_operations.append(
+                UpdateOne(
+                    {"_id": match_id},
+                    {"$push": {"commentary": {"$each": commentary, "$position": 0}}},
+                    upsert=True,
+                )
+            )
+
+    def _project_commentary(self, commentary: list) -> list:
+        """
+        Keeps only the projected fields of the commentary entries
+        """
+        if not constants.STORE_PROJECTED:
+            return commentary
+        return [self.commentary_projection.apply(comment) for comment in commentary]
 
-                match = self.db.matches.find_one({"_id": match_id})
-                if match["matchHeader"]["state"] != "In Progress":
-                    # Update match fullCommentaryExists to True if match is finished
-                    self.db.matches.update_one(
-                        {"_id": match_id},
-                        {"$set": {"fullCommentaryExists": True}},
-                        session=session,
-                    )
+    def _upsert_commentary_entries(
+        self, match_id: int, commentary: list, batch: "WriteBatch"
+    ) -> None:
+        """
+        Queues one upsert per commentary entry, keyed on the match, innings and
+        timestamp of the entry
+        """
+        for comment in commentary:
+            key = {
+                "matchId": match_id,
+                "inningsId": comment.get("inningsId"),
+                "timestamp": comment["timestamp"],
+            }
+            batch.commentary_operations.append(
+                UpdateOne(key, {"$set": {**comment, **key}}, upsert=True)
+            )
 
-                # Commit transaction
-                session.commit_transaction()
+    def mark_full_commentary_if_finished(
+        self, match: dict, batch: "WriteBatch"
+    ) -> None:
+        """
+        Queues fullCommentaryExists = True and archives the match once it has reached
+        a final state. Pauses such as innings breaks or stumps are still live
+        """
+        if match["matchHeader"]["state"] not in constants.MATCH_ARCHIVE_STATES:
+            return
+
+        match_id = match["matchHeader"]["matchId"]
+        update = batch.match_update(match_id)
+        update["$set"]["fullCommentaryExists"] = True
+        update["$setOnInsert"].pop("fullCommentaryExists", None)
+        update["$set"]["archived"] = True
+        update["$set"]["contentHash"] = self._content_hash(match)
+        update["$set"]["finalizedAt"] = datetime.now(timezone.utc)
+        batch.archived_match_ids.add(match_id)
+
+    def flush(self, batch: "WriteBatch") -> None:
+        """
+        Writes the batch with one bulk write per collection. Commentary is written
+        before the matches, so a match is only marked finished once its commentary
+        is stored, and every write is idempotent when retried
+        """
+        try:
+            if batch.commentary_operations:
+                self._commentary_collection().bulk_write(
+                    batch.commentary_operations, ordered=False
+                )
+            if batch.match_updates:
+                self.db.matches.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": match_id},
+                            {op: fields for op, fields in update.items() if fields},
+                            upsert=True,
+                        )
+                        for match_id, update in batch.match_updates.items()
+                    ],
+                    ordered=False,
+                )
+            if batch.raw_operations:
+                self.db.raw_matches.bulk_write(batch.raw_operations, ordered=False)
+            self._match_field_hashes.update(batch.field_hashes)
         except Exception as e:
-            Logger.log_error(
-                f"Error updating full commentary for match {match_id}: {e}"
+            Logger.log_error(f"Error flushing the write batch: {e}")
+            raise e
+
+    def archive_commentary(self, match_id: int) -> None:
+        """
+        Moves the commentary of a finished match to compressed chunks in the archive
+        collection. Each chunk is a gzip of consecutive BSON documents, oldest first,
+        and the hot copy is only deleted once every chunk is written
+        """
+        try:
+            if self.ball_storage:
+                commentary = (
+                    self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+                    .find({"matchId": match_id}, {"_id": 0, "matchId": 0})
+                    .sort("timestamp", ASCENDING)
+                )
+            else:
+                stored = self.db.commentaries.find_one({"_id": match_id})
+                commentary = reversed(stored["commentary"] if stored else [])
+
+            archive = self.db[constants.COMMENTARY_ARCHIVE_COLLECTION]
+            entries = iter(commentary)
+            for seq in itertools.count():
+                chunk = list(itertools.islice(entries, constants.ARCHIVE_CHUNK_ENTRIES))
+                if not chunk:
+                    break
+                data = gzip.compress(b"".join(bson.encode(c) for c in chunk))
+                archive.replace_one(
+                    {"_id": f"{match_id}:{seq}"},
+                    {
+                        "matchId": match_id,
+                        "seq": seq,
+                        "count": len(chunk),
+                        "firstTimestamp": chunk[0]["timestamp"],
+                        "lastTimestamp": chunk[-1]["timestamp"],
+                        "data": bson.Binary(data),
+                    },
+                    upsert=True,
+                )
+            # Drop chunks left over from an earlier, longer archive of the match
+            archive.delete_many({"matchId": match_id, "seq": {"$gte": seq}})
+
+            self.db.matches.update_one(
+                {"_id": match_id}, {"$set": {"commentaryArchived": True}}
+            )
+            if self.ball_storage:
+                self.db[constants.COMMENTARY_ENTRIES_COLLECTION].delete_many(
+                    {"matchId": match_id}
+                )
+            else:
+                self.db.commentaries.delete_one({"_id": match_id})
+        except Exception as e:
+            Logger.log_error(f"Error archiving commentary for match {match_id}: {e}")
+            raise e
+
+    def _commentary_collection(self):
+        """
+        Returns the collection the commentary is stored in
+        """
+        if self.ball_storage:
+            return self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+        return self.db.commentaries
+
+    def _field_hash(self, value) -> bytes:
+        """
+        Generates a short digest of a match field
+        """
+        return hashlib.blake2b(bson.encode({"v": value}), digest_size=16).digest()
+
+    def _content_hash(self, match: dict) -> str:
+        """
+        Generates a SHA-256 hash of the stored match data
+        """
+        data = json.dumps(match, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def fetch_checkpoints(self, match_ids: list) -> dict:
+        """
+        Fetches the backfill cursors of the unfinished innings of the given matches,
+        keyed by match id and then innings id. Matches whose checkpoints are all
+        complete map to an empty dict
+        """
+        try:
+            checkpoints = {}
+            for checkpoint in self.db.checkpoints.find({"matchId": {"$in": match_ids}}):
+                match_checkpoints = checkpoints.setdefault(checkpoint["matchId"], {})
+                if not checkpoint["complete"]:
+                    match_checkpoints[checkpoint["inningsId"]] = checkpoint["cursor"]
+            return checkpoints
+        except Exception as e:
+            Logger.log_error(f"Error fetching checkpoints: {e}")
+            raise e
+
+    def save_checkpoint(
+        self, match_id: int, innings_id: int, cursor: int, complete: bool
+    ) -> None:
+        """
+        Saves the backfill cursor of an innings
+        """
+        try:
+            self.db.checkpoints.update_one(
+                {"_id": f"{match_id}:{innings_id}"},
+                {
+                    "$set": {
+                        "matchId": match_id,
+                        "inningsId": innings_id,
+                        "cursor": cursor,
+                        "complete": complete,
+                        "updatedAt": datetime.now(timezone.utc),
+                    }
+                },
+                upsert=True,
             )
-            session.abort_transaction()
+        except Exception as e:
+            Logger.log_error(f"Error saving checkpoint for match {match_id}: {e}")
+            raise e
+
+    def delete_checkpoints(self, match_id: int) -> None:
+        """
+        Deletes the backfill cursors of a match
+        """
+        try:
+            self.db.checkpoints.delete_many({"matchId": match_id})
+        except Exception as e:
+            Logger.log_error(f"Error deleting checkpoints for match {match_id}: {e}")
+            raise e
+
+    def write_commentary_entries(self, match_id: int, commentary: list) -> None:
+        """
+        Writes commentary entries right away, outside of the cycle write batch
+        """
+        batch = WriteBatch()
+        self.append_commentary(match_id, commentary, batch)
+        if batch.commentary_operations:
+            self._commentary_collection().bulk_write(
+                batch.commentary_operations, ordered=False
+            )
+
+    def claim_match_lease(self, match_id: int, owner: str, ttl: float) -> bool:
+        """
+        Claims the lease of a match if it is free, expired or already owned
+        """
+        try:
+            now = datetime.now(timezone.utc)
+            self.db.leases.update_one(
+                {
+                    "_id": match_id,
+                    "$or": [{"owner": owner}, {"expiresAt": {"$lt": now}}],
+                },
+                {"$set": {"owner": owner, "expiresAt": now + timedelta(seconds=ttl)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists and is held by another instance
+            return False
+        except Exception as e:
+            Logger.log_error(f"Error claiming lease for match {match_id}: {e}")
+            raise e
+
+    def renew_match_leases(self, match_ids: list, owner: str, ttl: float) -> set:
+        """
+        Extends the leases still owned for the given matches, returns the ids of the
+        matches which are still owned
+        """
+        try:
+            # Leases taken over by another instance no longer match the owner
+            query = {"_id": {"$in": match_ids}, "owner": owner}
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+            self.db.leases.update_many(query, {"$set": {"expiresAt": expires_at}})
+            return {lease["_id"] for lease in self.db.leases.find(query, {"_id": 1})}
+        except Exception as e:
+            Logger.log_error(f"Error renewing match leases: {e}")
+            raise e
+
+    def release_match_leases(self, match_ids: list, owner: str) -> None:
+        """
+        Releases the leases owned for the given matches
+        """
+        try:
+            self.db.leases.delete_many({"_id": {"$in": match_ids}, "owner": owner})
+        except Exception as e:
+            Logger.log_error(f"Error releasing match leases: {e}")
+            raise e
 
     def close(self) -> None:
         """
         Closes the database connection
         """
         try:
-            self.client.close()
+            if Database.__client is not None:
+                Database.__client.close()
+                Database.__client = None
         except Exception as e:
             Logger.log_error(f"Error closing the database connection: {e}")
             raise e
+
+
+class WriteBatch:
+    """
+    Collects the match and commentary writes of a fetch cycle
+    """
+
+    def __init__(self) -> None:
+        self.match_updates = {}
+        self.commentary_operations = []
+        self.raw_operations = []
+        self.archived_match_ids = set()
+        self.field_hashes = {}
+        # match id -> highest queued commentary timestamp of each innings
+        self.watermarks = {}
+
+    def match_update(self, match_id: int) -> dict:
+        """
+        Returns the pending update of a match, creating it if needed
+        """
+        return self.match_updates.setdefault(
+            match_id, {"$set": {}, "$setOnInsert": {}}
+        )
+
+    def advance_watermarks(self, match_id: int, commentary: list) -> None:
+        """
+        Records the highest timestamp of each innings in the commentary
+        """
+        watermarks = self.watermarks.setdefault(match_id, {})
+        for comment in commentary:
+            innings_id = comment.get("inningsId")
+            if comment["timestamp"] > watermarks.get(innings_id, -1):
+                watermarks[innings_id] = comment["timestamp"]
@@ -34,6 +34,9 @@ class Environment:
         """
         Returns the mongo uri
         """
+        if not self.mongo_user:
+            # A local mongod without authentication
+            return f"{self.mongo_protocol}://{self.mongo_host}/?{self.mongo_options or ''}"
         mongo_uri = f"{self.mongo_protocol}://{self.mongo_user}:{self.mongo_pwd}@{self.mongo_host}/?{self.mongo_options}"
         return mongo_uri
 
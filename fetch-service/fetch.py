@@ -1,12 +1,21 @@
 import asyncio
 
 import constants
+from catalog import MatchCatalog
+from checkpoint import CommentaryCheckpoint
+from codec import Codec
 from cricbuzz import Cricbuzz
-from database import Database
+from database import Database, WriteBatch
+from lease import MatchLeases
 from logger import Logger
+from metrics import Metrics
+from scheduler import PollScheduler
 
 cb = Cricbuzz()
-mongodb = Database()
+mongodb = Database.get_instance()
+catalog = MatchCatalog(cb, constants.MATCH_DISCOVERY_INTERVAL)
+scheduler = PollScheduler()
+leases = MatchLeases(mongodb)
 
 
 class Fetcher:
@@ -14,96 +23,311 @@ class Fetcher:
     Fetches the data from cricbuzz and pushes it to the database
     """
 
-    def fetch_live_matches(self) -> set:
+    def __init__(self) -> None:
+        self._catalog_version = 0
+        self._prefetched = {}
+        # match id -> highest stored commentary timestamp of each innings, loaded
+        # once per match and advanced after every flush
+        self._watermarks = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
         """
-        Fetches the ids of live matches
+        Asks the fetch loops to stop once their in-flight cycle is done
         """
-        active_matches = set()
+        self._stopping.set()
 
-        ids = cb.fetch_current_macth_id()
-        for match_id in ids:
-            match = cb.fetch_match(match_id)
-            match_state = match["matchHeader"]["state"] if match else None
-            if match_state == "In Progress":
-                active_matches.add(int(match_id))
-        return active_matches
+    async def _sleep(self, seconds: float) -> None:
+        """
+        Sleeps for the given seconds, waking up early if the fetcher is stopped
+        """
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
 
-    def fetch_completed_matches(self) -> set:
+    async def fetch_live_matches(self) -> dict:
         """
-        Fetches the ids of completed matches
+        Fetches the live matches keyed by their ids
         """
-        completed_matches = set()
+        return await catalog.matches_in_state("In Progress")
 
-        ids = cb.fetch_current_macth_id()
-        for match_id in ids:
-            match = cb.fetch_match(match_id)
-            match_state = match["matchHeader"]["state"] if match else None
-            if match_state == "Complete":
-                completed_matches.add(int(match_id))
-        return completed_matches
+    async def fetch_completed_matches(self) -> dict:
+        """
+        Fetches the completed matches which are not archived yet, keyed by their ids
+        """
+        return self._skip_archived(await catalog.matches_in_state("Complete"))
 
-    async def push_match_to_db(self, match_id: int) -> None:
+    def _skip_archived(self, matches: dict) -> dict:
         """
-        Pushes the match data to the database
+        Removes the matches which are already archived in the database
         """
-        Logger.log_info(f"Fetching data for match {match_id}")
-        match = cb.fetch_match(match_id)
-        if not match:
-            Logger.log_info(f"The match ID has no data yet: {match_id}")
-            return
-        mongodb.upsert_match(match)
-        Logger.log_info(f"pushed data for match {match_id}")
+        archived = mongodb.fetch_archived_match_ids(list(matches))
+        catalog.mark_archived(archived)
+        return {
+            match_id: match
+            for match_id, match in matches.items()
+            if match_id not in archived
+        }
+
+    async def push_matches_to_db(self, matches: dict) -> dict:
+        """
+        Pushes the already fetched matches and their new commentary to the database
+        in one batch, returns the number of commentary entries pushed per match
+        """
+        matches = {match_id: match for match_id, match in matches.items() if match}
+        if not matches:
+            return {}
+
+        batch = WriteBatch()
+        for match in matches.values():
+            mongodb.upsert_match(match, batch)
+
+        match_ids = list(matches)
+        full_commentary = mongodb.fetch_full_commentary_flags(match_ids)
+        unknown = [
+            match_id for match_id in match_ids if match_id not in self._watermarks
+        ]
+        if unknown:
+            loaded = mongodb.fetch_commentary_watermarks(unknown)
+            for match_id in unknown:
+                self._watermarks[match_id] = loaded.get(match_id, {})
+        checkpoints = mongodb.fetch_checkpoints(match_ids)
+        # Archives which failed after the match was marked archived are retried
+        batch.archived_match_ids |= mongodb.fetch_pending_archive_ids(match_ids)
+        new_entries = await asyncio.gather(
+            *[
+                self.fetch_commentary_push_db(
+                    match_id,
+                    match,
+                    full_commentary.get(match_id, False),
+                    dict(self._watermarks[match_id]),
+                    checkpoints.get(match_id),
+                    batch,
+                )
+                for match_id, match in matches.items()
+            ]
+        )
 
-    async def fetch_commentary_push_db(self, match_id: int) -> None:
+        if len(batch.commentary_operations) >= constants.CODEC_OFFLOAD_ENTRIES:
+            # Keep BSON encoding of large backfills off the event loop
+            await Codec.run_offloaded(mongodb.flush, batch)
+        else:
+            mongodb.flush(batch)
+        Logger.log_info("pushed data for matches %s", set(matches))
+        for match_id, watermarks in batch.watermarks.items():
+            stored = self._watermarks.setdefault(match_id, {})
+            for innings_id, timestamp in watermarks.items():
+                stored[innings_id] = max(stored.get(innings_id, -1), timestamp)
+
+        for match_id in batch.archived_match_ids:
+            # Compression runs off the event loop
+            await Codec.run_offloaded(mongodb.archive_commentary, match_id)
+            catalog.mark_archived({match_id})
+            self._watermarks.pop(match_id, None)
+        return dict(zip(match_ids, new_entries))
+
+    async def fetch_commentary_push_db(
+        self,
+        match_id: int,
+        match: dict,
+        full_commentary_exists: bool,
+        watermarks: dict,
+        cursors: dict,
+        batch: WriteBatch,
+    ) -> int:
         """
-        Fetches the commentary and pushes it to the database
+        Fetches the commentary and adds it to the write batch, returns the number of
+        entries pushed. Cursors is None when the match has no backfill checkpoints
         """
-        match = mongodb.check_match_exists(match_id)
-        if match and not match["fullCommentaryExists"]:
-            Logger.log_info(f"Fetching commentary for match {match_id}")
-            commentary = cb.fetch_commentary(match)
-            mongodb.update_commentary(match_id, commentary)
-            Logger.log_info(f"pushed commentary for match {match_id}")
+        if full_commentary_exists:
+            return 0
+
+        # Backfill pages are saved as they arrive, which needs one document per ball
+        checkpoint = None
+        if mongodb.ball_storage:
+            checkpoint = CommentaryCheckpoint(mongodb, match_id)
+
+        if cursors and checkpoint is not None:
+            Logger.log_info("Resuming commentary backfill for match %s", match_id)
+            if not await cb.resume_commentary(match_id, cursors, checkpoint):
+                return 0
+            await checkpoint.finish()
+            watermarks = mongodb.fetch_commentary_watermarks([match_id])
+            watermarks = watermarks.get(match_id, {})
+            batch.watermarks.setdefault(match_id, {}).update(watermarks)
+        elif cursors is not None:
+            # Complete checkpoints left by a crash before finish(), or checkpoints of
+            # the ball storage after switching to arrays
+            mongodb.delete_checkpoints(match_id)
+
+        if not watermarks:
+            Logger.log_info("Fetching full commentary for match %s", match_id)
+            commentary = await cb.fetch_commentary(match, checkpoint)
+            if commentary is None:
+                return 0
+            if checkpoint is not None:
+                # Backfilled pages are already stored, only queue the rest
+                mongodb.update_commentary(
+                    match_id, checkpoint.unsaved(commentary), batch
+                )
+                await checkpoint.finish()
+            else:
+                mongodb.update_commentary(match_id, commentary, batch)
+        else:
+            Logger.log_info("Fetching new commentary for match %s", match_id)
+            commentary = await cb.fetch_commentary_since(match, watermarks)
+            if commentary is None:
+                return 0
+            mongodb.append_commentary(match_id, commentary, batch)
+        batch.advance_watermarks(match_id, commentary)
+        mongodb.mark_full_commentary_if_finished(match, batch)
+        return len(commentary)
 
     async def fetch_completed_match_data(self) -> None:
         """
         Fetches the completed matches and pushes them to the database
         """
-        while True:
-            completed_matches = self.fetch_completed_matches()
-            Logger.log_info(f"Completed matches: {completed_matches}")
+        while not self._stopping.is_set():
+            completed_matches = await self.fetch_completed_matches()
+            # Matches still scheduled are finished off by the live loop
+            unscheduled = set(completed_matches) - scheduler.match_ids()
+            previously_owned = leases.owned()
+            owned = leases.claim(unscheduled)
+            Logger.log_info(f"Completed matches: {owned}")
 
-            task_push_match_to_db = [
-                self.push_match_to_db(match_id) for match_id in completed_matches
-            ]
+            try:
+                await self.push_matches_to_db(
+                    {match_id: completed_matches[match_id] for match_id in owned}
+                )
+                Logger.log_info("Completed matches pushed to db")
+            except Exception as e:
+                Logger.log_error(f"Error pushing completed matches to db: {e}")
+            finally:
+                # Leases held before this cycle belong to the live loop
+                leases.release(owned - previously_owned)
+                for match_id in owned - previously_owned:
+                    self._watermarks.pop(match_id, None)
+            await self._sleep(constants.GAME_COMPLETED_FETCH_SLEEP)
 
-            task_push_completed_matches = [
-                self.fetch_commentary_push_db(match_id)
-                for match_id in completed_matches
-            ]
+    async def fetch_running_match_data(self) -> None:
+        """
+        Fetches the running matches and pushes them to the database, polling each
+        match when it is due
+        """
+        while not self._stopping.is_set():
+            if cb.is_degraded():
+                Logger.log_info("Cricbuzz is degraded, pausing live polling")
+                await self._sleep(constants.GAME_UPDATE_FETCH_SLEEP)
+                continue
 
-            await asyncio.gather(*task_push_match_to_db)
-            await asyncio.gather(*task_push_completed_matches)
-            Logger.log_info("Completed matches pushed to db")
-            await asyncio.sleep(constants.GAME_COMPLETED_FETCH_SLEEP)
+            active_matches = await self.fetch_live_matches()
+            if catalog.version != self._catalog_version:
+                self._catalog_version = catalog.version
+                self._schedule_live_matches(active_matches)
 
-    async def fetch_running_match_data(self) -> None:
+            due_matches = scheduler.pop_due()
+            if due_matches:
+                Logger.log_info("Polling matches: %s", set(due_matches))
+                await self.poll_live_matches(due_matches)
+                Logger.log_info("Active matches pushed to db")
+
+            await self._sleep(
+                min(scheduler.time_until_next(), constants.GAME_UPDATE_FETCH_SLEEP)
+            )
+
+    def _schedule_live_matches(self, active_matches: dict) -> None:
         """
-        Fetches the running matches and pushes them to the database
+        Adds newly discovered live matches this instance can lease to the scheduler
+        and drops the matches which are no longer listed on cricbuzz
         """
-        while True:
-            active_matches = self.fetch_live_matches()
-            Logger.log_info(f"Active Matches: {active_matches}")
+        Logger.log_info(f"Active Matches: {set(active_matches)}")
+        unscheduled = set(active_matches) - scheduler.match_ids()
+        for match_id in leases.claim(unscheduled):
+            self._prefetched[match_id] = active_matches[match_id]
+            scheduler.add(match_id)
 
-            task_push_match_to_db = [
-                self.push_match_to_db(match_id) for match_id in active_matches
-            ]
+        listed_matches = catalog.match_ids()
+        for match_id in scheduler.match_ids() - listed_matches:
+            self._stop_polling(match_id)
 
-            task_push_running_matches = [
-                self.fetch_commentary_push_db(match_id) for match_id in active_matches
-            ]
+    def _stop_polling(self, match_id: int) -> None:
+        """
+        Removes a match from the scheduler and releases its lease
+        """
+        scheduler.remove(match_id)
+        self._prefetched.pop(match_id, None)
+        self._watermarks.pop(match_id, None)
+        leases.release({match_id})
+
+    async def poll_live_matches(self, match_ids: list) -> None:
+        """
+        Fetches the due live matches, pushes the changed ones to the database in one
+        batch and reschedules them
+        """
+        polled = await asyncio.gather(
+            *[self._fetch_live_match(match_id) for match_id in match_ids]
+        )
+        matches = {match_id: match for match_id, match, _ in polled}
+        changed_matches = {
+            match_id: match for match_id, match, changed in polled if changed
+        }
+
+        try:
+            new_entries = await self.push_matches_to_db(changed_matches)
+        except Exception as e:
+            Logger.log_error(f"Error pushing live matches to db: {e}")
+            # Push them again on the next poll even if cricbuzz reports no change
+            cb.forget_matches(set(changed_matches))
+            new_entries = {}
+
+        for match_id, match in matches.items():
+            state = match["matchHeader"]["state"] if match else None
+            if state in constants.MATCH_ARCHIVE_STATES:
+                self._stop_polling(match_id)
+            else:
+                scheduler.record(match_id, state, new_entries.get(match_id, 0))
 
-            await asyncio.gather(*task_push_match_to_db)
-            await asyncio.gather(*task_push_running_matches)
-            Logger.log_info("Active matches pushed to db")
-            await asyncio.sleep(constants.GAME_UPDATE_FETCH_SLEEP)
+    async def _fetch_live_match(self, match_id: int) -> tuple:
+        """
+        Fetches a live match, returns the match id, the match and whether it changed
+        """
+        if match_id in self._prefetched:
+            return match_id, self._prefetched.pop(match_id), True
+        match, changed = await cb.fetch_match_changes(match_id)
+        return match_id, match, changed
+
+    async def renew_leases(self) -> None:
+        """
+        Renews the match leases periodically and stops polling the matches taken
+        over by another instance
+        """
+        while not self._stopping.is_set():
+            await self._sleep(constants.LEASE_RENEW_INTERVAL)
+            try:
+                for match_id in leases.renew():
+                    scheduler.remove(match_id)
+                    self._prefetched.pop(match_id, None)
+                    # Another instance writes the commentary from now on
+                    self._watermarks.pop(match_id, None)
+            except Exception as e:
+                Logger.log_error(f"Error renewing leases: {e}")
+
+    async def report_metrics(self) -> None:
+        """
+        Logs the metrics periodically
+        """
+        while not self._stopping.is_set():
+            await self._sleep(constants.METRICS_LOG_INTERVAL)
+            Metrics.log_snapshot()
+
+    async def close(self) -> None:
+        """
+        Releases the match leases and closes the cricbuzz client
+        """
+        try:
+            leases.release_all()
+        except Exception as e:
+            Logger.log_error(f"Error releasing leases: {e}")
+        await cb.close()
+        Codec.shutdown()
@@ -0,0 +1,76 @@
+import os
+import socket
+import uuid
+
+import constants
+from database import Database
+from logger import Logger
+
+
+class MatchLeases:
+    """
+    Coordinates the fetcher instances through expiring leases in MongoDB, so
+    every match is polled by a single instance
+    """
+
+    def __init__(self, mongodb: Database) -> None:
+        self.mongodb = mongodb
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._owned = set()
+
+    def owned(self) -> set:
+        """
+        Returns the ids of the matches this instance holds the lease for
+        """
+        return set(self._owned)
+
+    def claim(self, match_ids: set) -> set:
+        """
+        Claims the leases of the given matches, returns the ids of the matches this
+        instance now owns
+        """
+        claimed = set()
+        for match_id in match_ids:
+            if self.mongodb.claim_match_lease(
+                match_id, self.owner, constants.LEASE_TTL
+            ):
+                claimed.add(match_id)
+
+        new_matches = claimed - self._owned
+        if new_matches:
+            Logger.log_info("Claimed leases for matches %s", new_matches)
+        self._owned |= claimed
+        return claimed
+
+    def renew(self) -> set:
+        """
+        Extends the owned leases, returns the ids of the matches which were lost to
+        another instance
+        """
+        if not self._owned:
+            return set()
+
+        still_owned = self.mongodb.renew_match_leases(
+            list(self._owned), self.owner, constants.LEASE_TTL
+        )
+        lost = self._owned - still_owned
+        if lost:
+            Logger.log_info("Lost leases for matches %s", lost)
+        self._owned = still_owned
+        return lost
+
+    def release(self, match_ids: set) -> None:
+        """
+        Gives up the leases of the given matches
+        """
+        owned = self._owned & set(match_ids)
+        if owned:
+            self.mongodb.release_match_leases(list(owned), self.owner)
+            self._owned -= owned
+
+    def release_all(self) -> None:
+        """
+        Gives up every lease held by this instance, letting others take over
+        immediately
+        """
+        self.release(self._owned)
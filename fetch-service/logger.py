@@ -1,12 +1,50 @@
-import inspect
+import atexit
+import json
 import logging
 import os
+import queue
+import reprlib
 import sys
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one json object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "file": record.filename,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues records without formatting them, so the message is only built by the
+    listener thread
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
 
 class Logger:
     __instance = None
     __filename = None
+    __listener = None
+    __payload_max_chars = 1000
+    __payload_sample_rate = 1
+    __payload_counts = Counter()
+    __payload_repr = reprlib.Repr()
 
     @classmethod
     def get_instance(cls) -> logging.Logger:
@@ -19,7 +57,9 @@ class Logger:
             )
         return cls.__instance
 
-    def __init__(self, filename: str) -> None:
+    def __init__(
+        self, filename: str, json_format: bool = False, level: str = "DEBUG"
+    ) -> None:
         if Logger.__filename is not None and Logger.__filename != filename:
             raise ValueError(
                 "Cannot create multiple instances of Logger. Use Logger.get_instance() to get the instance."
@@ -27,23 +67,48 @@ class Logger:
         Logger.__filename = filename
 
         time_stamp_format = "%Y-%m-%d %H:%M:%S"
-        formatter = logging.Formatter(
-            "%(asctime)s %(levelname)s %(filename)s: %(message)s",
-            datefmt=time_stamp_format,
-        )
+        if json_format:
+            formatter = JsonFormatter(datefmt=time_stamp_format)
+        else:
+            formatter = logging.Formatter(
+                "%(asctime)s %(levelname)s %(filename)s: %(funcName)s: %(message)s",
+                datefmt=time_stamp_format,
+            )
 
         if Logger.__instance is None:
-            logging.basicConfig(filename=filename, level=logging.DEBUG)
-            logger = logging.getLogger()
-            logger.handlers[0].setFormatter(formatter)
+            file_handler = logging.FileHandler(filename)
+            file_handler.setFormatter(formatter)
 
             console_handler = logging.StreamHandler(sys.stdout)
             console_handler.setLevel(logging.DEBUG)
             console_handler.setFormatter(formatter)
-            logger.addHandler(console_handler)
+            handlers = [file_handler, console_handler]
+
+            # File and console I/O happen on the listener thread
+            log_queue = queue.SimpleQueue()
+            logger = logging.getLogger()
+            logger.setLevel(level)
+            logger.addHandler(DeferredQueueHandler(log_queue))
+
+            Logger.__listener = QueueListener(
+                log_queue, *handlers, respect_handler_level=True
+            )
+            Logger.__listener.start()
+            atexit.register(Logger.__listener.stop)
 
             Logger.__instance = logger
 
+    @classmethod
+    def configure_payload_logging(cls, max_chars: int, sample_rate: int) -> None:
+        """
+        Sets the size cap and the one in N sampling of payload logs
+        """
+        cls.__payload_max_chars = max_chars
+        cls.__payload_sample_rate = max(1, sample_rate)
+        cls.__payload_repr.maxstring = max_chars
+        cls.__payload_repr.maxother = max_chars
+        cls.__payload_repr.maxlist = cls.__payload_repr.maxdict = 50
+
     @classmethod
     def clear_log_file(cls) -> bool:
         """
@@ -70,33 +135,50 @@ class Logger:
             return False
 
     @classmethod
-    def log_debug(cls, message: str) -> None:
+    def log_debug(cls, message: str, *args) -> None:
         """
         Logs a debug message
         """
-        func_name = inspect.stack()[1][3]
-        cls.__instance.debug(f"{func_name}: {message}")
+        cls.__instance.debug(message, *args, stacklevel=2)
 
     @classmethod
-    def log_info(cls, message: str) -> None:
+    def log_info(cls, message: str, *args) -> None:
         """
         Logs an info message
         """
-        func_name = inspect.stack()[1][3]
-        cls.__instance.info(f"{func_name}: {message}")
+        cls.__instance.info(message, *args, stacklevel=2)
 
     @classmethod
-    def log_error(cls, message: str) -> None:
+    def log_error(cls, message: str, *args) -> None:
         """
         Logs an error message
         """
-        func_name = inspect.stack()[1][3]
-        cls.__instance.error(f"{func_name}: {message}")
+        cls.__instance.error(message, *args, stacklevel=2)
 
     @classmethod
-    def log_exception(cls, message: str) -> None:
+    def log_exception(cls, message: str, *args) -> None:
         """
         Logs an exception message
         """
-        func_name = inspect.stack()[1][3]
-        cls.__instance.exception(f"{func_name}: {message}")
+        cls.__instance.exception(message, *args, stacklevel=2)
+
+    @classmethod
+    def log_payload(cls, message: str, payload, *args) -> None:
+        """
+        Logs a debug message followed by a truncated payload. Only one in every N
+        calls with the same message is logged, and nothing is formatted when debug
+        logging is disabled
+        """
+        if not cls.__instance.isEnabledFor(logging.DEBUG):
+            return
+
+        count = cls.__payload_counts[message]
+        cls.__payload_counts[message] = count + 1
+        if count % cls.__payload_sample_rate:
+            return
+
+        # reprlib stops at the nested size limits instead of building the full repr
+        text = cls.__payload_repr.repr(payload)
+        if len(text) > cls.__payload_max_chars:
+            text = text[: cls.__payload_max_chars] + "..."
+        cls.__instance.debug(f"{message}: %s", *args, text, stacklevel=2)
@@ -1,12 +1,14 @@
 import asyncio
+import signal
 
 import constants
+from database import Database
 from environment import Environment
 from fetch import Fetcher
 from logger import Logger
 
 # Create a logger instance
-Logger(constants.LOG_FILE)
+Logger(constants.LOG_FILE, constants.LOG_JSON, constants.LOG_LEVEL)
 Logger.log_info(f"Starting execution for fetcher service...")
 Logger.log_info(f"Logger setup success for file {constants.LOG_FILE}...")
 
@@ -19,16 +21,38 @@ async def main() -> None:
     Runs the fetch tasks
     """
     fetcher = Fetcher()
+    loop = asyncio.get_running_loop()
 
     try:
+        Database.get_instance().prepare()
         fetch_tasks = [
-            fetcher.fetch_running_match_data(),
-            fetcher.fetch_completed_match_data(),
+            asyncio.create_task(fetcher.fetch_running_match_data()),
+            asyncio.create_task(fetcher.fetch_completed_match_data()),
+            asyncio.create_task(fetcher.renew_leases()),
+            asyncio.create_task(fetcher.report_metrics()),
         ]
 
+        def shutdown() -> None:
+            """
+            Lets the in-flight cycles finish, cancelling them after the drain timeout
+            """
+            Logger.log_info("Shutting down, draining in-flight work...")
+            fetcher.stop()
+            loop.call_later(
+                constants.SHUTDOWN_DRAIN_TIMEOUT,
+                lambda: [task.cancel() for task in fetch_tasks],
+            )
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, shutdown)
+
         await asyncio.gather(*fetch_tasks)
+    except asyncio.CancelledError:
+        Logger.log_info("In-flight work cancelled after the drain timeout")
     except Exception as e:
         Logger.log_error(f"Error in main: {e}")
+    finally:
+        await fetcher.close()
 
 
 if __name__ == "__main__":
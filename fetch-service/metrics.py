@@ -0,0 +1,32 @@
+from collections import Counter
+
+from logger import Logger
+
+
+class Metrics:
+    """
+    Process wide counters reported to the log
+    """
+
+    __counters = Counter()
+
+    @classmethod
+    def increment(cls, name: str, value: int = 1) -> None:
+        """
+        Increments a counter
+        """
+        cls.__counters[name] += value
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        """
+        Returns a copy of all the counters
+        """
+        return dict(cls.__counters)
+
+    @classmethod
+    def log_snapshot(cls) -> None:
+        """
+        Logs all the counters
+        """
+        Logger.log_info(f"Metrics: {cls.snapshot()}")
@@ -0,0 +1,32 @@
+class Projection:
+    """
+    Keeps only the configured fields of a document, given as dotted paths
+    """
+
+    def __init__(self, paths: list) -> None:
+        # Nested dict of the paths, a None leaf keeps the whole value
+        self.tree = {}
+        for path in paths:
+            node = self.tree
+            *parents, leaf = path.split(".")
+            for key in parents:
+                node = node.setdefault(key, {})
+            node[leaf] = None
+
+    def apply(self, document: dict) -> dict:
+        """
+        Returns a new document with only the projected fields
+        """
+        return self._apply(self.tree, document)
+
+    def _apply(self, tree: dict, document: dict) -> dict:
+        projected = {}
+        for key, subtree in tree.items():
+            if key not in document:
+                continue
+            value = document[key]
+            if subtree is None:
+                projected[key] = value
+            elif isinstance(value, dict):
+                projected[key] = self._apply(subtree, value)
+        return projected
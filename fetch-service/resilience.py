@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from logger import Logger
+from metrics import Metrics
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request is attempted while the circuit breaker is open
+    """
+
+
+class TokenBucket:
+    """
+    Limits the rate of requests, allowing short bursts up to the capacity
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Waits until a token is available and takes it
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an upstream after consecutive failures. Once the cooldown has
+    passed a single trial request goes through, closing the circuit if it succeeds
+    and opening it again if it fails
+    """
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        # Start of the trial request, a trial which never reports back expires
+        # after the cooldown
+        self._probe_started_at = None
+
+    def is_open(self) -> bool:
+        """
+        Checks if requests are currently blocked
+        """
+        if self._opened_at is None:
+            return False
+        now = time.monotonic()
+        if now - self._opened_at < self.cooldown:
+            return True
+        return (
+            self._probe_started_at is not None
+            and now - self._probe_started_at < self.cooldown
+        )
+
+    def check(self) -> None:
+        """
+        Raises if requests are currently blocked, letting the trial request through
+        """
+        if self.is_open():
+            raise CircuitOpenError(f"Circuit for {self.name} is open")
+        if self._opened_at is not None:
+            self._probe_started_at = time.monotonic()
+
+    def record_success(self) -> None:
+        """
+        Closes the circuit after a successful request
+        """
+        if self._opened_at is not None:
+            Logger.log_info(f"Circuit for {self.name} closed")
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    def record_failure(self) -> None:
+        """
+        Counts a failed request and opens the circuit past the threshold, or again
+        when the trial request failed
+        """
+        self._failures += 1
+        if self._probe_started_at is not None:
+            Logger.log_error(f"Trial request for {self.name} failed, circuit reopened")
+            self._opened_at = time.monotonic()
+            self._probe_started_at = None
+        elif self._failures >= self.failure_threshold and self._opened_at is None:
+            Logger.log_error(
+                f"Circuit for {self.name} opened after {self._failures} failures"
+            )
+            Metrics.increment(f"{self.name}.circuit_opened")
+            self._opened_at = time.monotonic()
@@ -0,0 +1,99 @@
+import heapq
+import time
+
+import constants
+
+
+class PollScheduler:
+    """
+    Schedules the polling of each match, adapting the interval to the activity
+    observed on the match
+    """
+
+    def __init__(self) -> None:
+        self._queue = []
+        self._due = {}
+        self._last_activity = {}
+
+    def __contains__(self, match_id: int) -> bool:
+        return match_id in self._last_activity
+
+    def match_ids(self) -> set:
+        """
+        Returns the ids of the scheduled matches, including the ones being polled
+        right now
+        """
+        return set(self._last_activity)
+
+    def add(self, match_id: int) -> None:
+        """
+        Schedules a match to be polled right away
+        """
+        if match_id not in self._due:
+            now = time.monotonic()
+            self._last_activity[match_id] = now
+            self._schedule(match_id, now)
+
+    def remove(self, match_id: int) -> None:
+        """
+        Stops polling a match
+        """
+        self._due.pop(match_id, None)
+        self._last_activity.pop(match_id, None)
+
+    def pop_due(self) -> list:
+        """
+        Returns the ids of the matches which are due to be polled
+        """
+        now = time.monotonic()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            next_due, match_id = heapq.heappop(self._queue)
+            # Skip entries of removed or rescheduled matches
+            if self._due.get(match_id) == next_due:
+                del self._due[match_id]
+                due.append(match_id)
+        return due
+
+    def time_until_next(self) -> float:
+        """
+        Returns the seconds until the next match is due
+        """
+        while self._queue and self._due.get(self._queue[0][1]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return constants.MATCH_POLL_MAX_INTERVAL
+        return max(0.0, self._queue[0][0] - time.monotonic())
+
+    def record(self, match_id: int, state: str, new_entries: int) -> None:
+        """
+        Reschedules a polled match based on its state and the new commentary found
+        """
+        if match_id not in self._last_activity:
+            return
+
+        now = time.monotonic()
+        # A failed poll has no state and keeps the live pace
+        if state == "In Progress" or state is None:
+            if new_entries:
+                self._last_activity[match_id] = now
+            # Poll faster while balls are arriving and back off as the match goes quiet
+            idle = now - self._last_activity[match_id]
+            interval = min(
+                max(
+                    idle * constants.MATCH_POLL_IDLE_FACTOR,
+                    constants.GAME_UPDATE_FETCH_SLEEP,
+                ),
+                constants.MATCH_POLL_MAX_INTERVAL,
+            )
+        else:
+            # Innings break, stumps, rain delays and other pauses
+            interval = constants.MATCH_BREAK_POLL_INTERVAL
+        self._schedule(match_id, now + interval)
+
+    def _schedule(self, match_id: int, next_due: float) -> None:
+        """
+        Pushes the next poll of a match to the queue
+        """
+        self._due[match_id] = next_due
+        heapq.heappush(self._queue, (next_due, match_id))
@@ -4,6 +4,47 @@ Constants
 
 # Notifier
 POLL_INTERVAL = 10
+# Threads shared by the match loops for database reads
+DB_WORKERS = 4
+# "change_stream" pushes new balls as they are inserted, "poll" reads every
+# POLL_INTERVAL seconds. Change streams need a replica set, polling is used otherwise
+LIVE_DELIVERY = "change_stream"
+CHANGE_STREAM_MAX_AWAIT_MS = 1000
+# Sent notifications are kept in memory and written once this many are pending or
+# the oldest pending one is this many seconds old
+NOTIFICATION_FLUSH_SIZE = 50
+NOTIFICATION_FLUSH_INTERVAL = 5
+# Number of recent timestamps kept per user and match to drop repeated balls which
+# arrive below the watermark
+NOTIFICATION_DEDUP_WINDOW = 64
+
+# Database
+MONGO_MAX_POOL_SIZE = 10
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+# "ball" stores one document per commentary entry, "array" one document per match
+COMMENTARY_STORAGE_MODE = "ball"
+COMMENTARY_ENTRIES_COLLECTION = "commentary_entries"
+# Commentary of finished matches, as gzip compressed chunks of BSON documents
+COMMENTARY_ARCHIVE_COLLECTION = "commentary_archive"
+
+# Commentary fields used to render a notification
+RENDERED_COMMENTARY_FIELDS = [
+    "commText",
+    "timestamp",
+    "ballNbr",
+    "overNumber",
+    "inningsId",
+    "batTeamName",
+    "batTeamScore",
+    "commentaryFormats",
+]
 
 # Logger
+LOG_LEVEL = "DEBUG"
 LOG_FILE = "notifier-service.log"
+# Write one json object per log line instead of plain text
+LOG_JSON = False
+# Debug payloads are truncated and only one in every N is logged
+PAYLOAD_LOG_MAX_CHARS = 2000
+PAYLOAD_LOG_SAMPLE_RATE = 10
@@ -1,5 +1,14 @@
+import gzip
+import io
+from typing import Iterator
+
+import bson
+import constants
 from environment import Environment
 from logger import Logger
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.change_stream import ChangeStream
+from pymongo.errors import OperationFailure
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
@@ -11,14 +20,46 @@ class Database:
     Handles all the database operations
     """
 
-    def __init__(self):
-        try:
-            self.uri = env.get_mongo_uri()
-            self.client = MongoClient(self.uri, server_api=ServerApi("1"))
-            self.db = self.client["cricbuzz"]
-        except Exception as e:
-            Logger.log_error(f"Error connecting to MongoDB: {e}")
-            raise e
+    _instance = None
+    __client = None
+
+    @classmethod
+    def get_instance(cls) -> "Database":
+        """
+        Returns the Database instance shared by every module of the service
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def get_client(cls) -> MongoClient:
+        """
+        Returns the MongoClient shared by the service, creating it on first use
+        """
+        if cls.__client is None:
+            cls.__client = MongoClient(
+                env.get_mongo_uri(),
+                server_api=ServerApi("1"),
+                maxPoolSize=constants.MONGO_MAX_POOL_SIZE,
+                serverSelectionTimeoutMS=constants.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=constants.MONGO_CONNECT_TIMEOUT_MS,
+            )
+        return cls.__client
+
+    @property
+    def client(self) -> MongoClient:
+        """
+        Returns the shared client
+        """
+        return Database.get_client()
+
+    @property
+    def db(self):
+        """
+        Returns the cricbuzz database of the shared client
+        """
+        return self.client["cricbuzz"]
 
     def fetch_active_match_ids(self) -> set:
         """
@@ -44,7 +85,7 @@ class Database:
 
     def fetch_commentary(self, match_id: str) -> list:
         """
-        Fetches the commentary of a match from the database
+        Fetches the commentary array of a match from the database, newest first
         """
         try:
             commentary = self.db.commentaries.find_one({"_id": int(match_id)})
@@ -53,6 +94,151 @@ class Database:
             Logger.log_error(f"Error fetching commentary for match {match_id}: {e}")
             raise e
 
+    def fetch_commentary_since(
+        self, match_id: str, timestamp: int, limit: int = 0
+    ) -> list:
+        """
+        Fetches the commentary of a match newer than the timestamp, oldest first and
+        with only the rendered fields. With a limit, only the latest entries are
+        returned
+        """
+        try:
+            fields = constants.RENDERED_COMMENTARY_FIELDS
+            if constants.COMMENTARY_STORAGE_MODE == "ball":
+                entries = (
+                    self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+                    .find(
+                        {"matchId": int(match_id), "timestamp": {"$gt": timestamp}},
+                        {"_id": 0, **{field: 1 for field in fields}},
+                    )
+                    .sort("timestamp", DESCENDING if limit else ASCENDING)
+                    .limit(limit)
+                )
+                commentary = list(entries)
+                return commentary[::-1] if limit else commentary
+
+            pipeline = [
+                {"$match": {"_id": int(match_id)}},
+                {
+                    "$project": {
+                        "commentary": {
+                            "$filter": {
+                                "input": "$commentary",
+                                "cond": {"$gt": ["$$this.timestamp", timestamp]},
+                            }
+                        }
+                    }
+                },
+                {"$unwind": "$commentary"},
+                {"$replaceRoot": {"newRoot": "$commentary"}},
+                {"$project": {"_id": 0, **{field: 1 for field in fields}}},
+                {"$sort": {"timestamp": -1 if limit else 1}},
+            ]
+            if limit:
+                pipeline.append({"$limit": limit})
+            commentary = list(self.db.commentaries.aggregate(pipeline))
+            return commentary[::-1] if limit else commentary
+        except Exception as e:
+            Logger.log_error(
+                f"Error fetching new commentary for match {match_id}: {e}"
+            )
+            raise e
+
+    def iter_commentary(self, match_id: str) -> Iterator[dict]:
+        """
+        Iterates over the commentary of a match oldest first, streaming it from the
+        compressed archive once every chunk of it is written
+        """
+        try:
+            archived = self.db.matches.find_one(
+                {"_id": int(match_id), "commentaryArchived": True}, {"_id": 1}
+            )
+            if archived:
+                chunks = (
+                    self.db[constants.COMMENTARY_ARCHIVE_COLLECTION]
+                    .find({"matchId": int(match_id)})
+                    .sort("seq", ASCENDING)
+                )
+                for chunk in chunks:
+                    stream = gzip.GzipFile(fileobj=io.BytesIO(chunk["data"]))
+                    yield from bson.decode_file_iter(stream)
+                return
+
+            if constants.COMMENTARY_STORAGE_MODE == "ball":
+                yield from (
+                    self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+                    .find({"matchId": int(match_id)}, {"_id": 0, "matchId": 0})
+                    .sort("timestamp", ASCENDING)
+                )
+            else:
+                yield from reversed(self.fetch_commentary(match_id))
+        except Exception as e:
+            Logger.log_error(f"Error iterating commentary for match {match_id}: {e}")
+            raise e
+
+    def supports_change_streams(self) -> bool:
+        """
+        Checks if the server is a replica set or a sharded cluster, the deployments
+        which support change streams
+        """
+        try:
+            hello = self.client.admin.command("hello")
+            return "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            Logger.log_error(f"Error checking change stream support: {e}")
+            return False
+
+    def watch_commentary(self, match_ids: list, resume_token: dict) -> ChangeStream:
+        """
+        Opens a change stream of the commentary entries inserted for the given
+        matches, resuming after the token if it is still in the oplog
+        """
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": "insert",
+                    "fullDocument.matchId": {"$in": [int(i) for i in match_ids]},
+                }
+            }
+        ]
+        collection = self.db[constants.COMMENTARY_ENTRIES_COLLECTION]
+        try:
+            return collection.watch(
+                pipeline,
+                resume_after=resume_token,
+                max_await_time_ms=constants.CHANGE_STREAM_MAX_AWAIT_MS,
+            )
+        except OperationFailure as e:
+            if resume_token is None:
+                raise e
+            Logger.log_info(f"Cannot resume change stream, starting a new one: {e}")
+            return collection.watch(
+                pipeline, max_await_time_ms=constants.CHANGE_STREAM_MAX_AWAIT_MS
+            )
+
+    def fetch_resume_token(self, key: str) -> dict:
+        """
+        Fetches the stored change stream resume token
+        """
+        try:
+            token = self.db.resume_tokens.find_one({"_id": key})
+            return token["token"] if token else None
+        except Exception as e:
+            Logger.log_error(f"Error fetching resume token {key}: {e}")
+            raise e
+
+    def save_resume_token(self, key: str, token: dict) -> None:
+        """
+        Stores the change stream resume token
+        """
+        try:
+            self.db.resume_tokens.update_one(
+                {"_id": key}, {"$set": {"token": token}}, upsert=True
+            )
+        except Exception as e:
+            Logger.log_error(f"Error saving resume token {key}: {e}")
+            raise e
+
     def fetch_match_header(self, match_id: int) -> dict:
         """
         Fetches the match data from the database
@@ -73,7 +259,10 @@ class Database:
             if user_exists is None:
                 # User doesn't exist, create new user data
                 notifications = {
-                    str(match_id): {"sentNotifications": {}, "lastNotificationSent": -1}
+                    str(match_id): {
+                        "recentNotifications": [],
+                        "lastNotificationSent": -1,
+                    }
                 }
                 user_data = {
                     "_id": user_id,
@@ -103,7 +292,7 @@ class Database:
                     {
                         "$set": {
                             f"notifications.{match_id}": {
-                                "sentNotifications": {},
+                                "recentNotifications": [],
                                 "lastNotificationSent": -1,
                             }
                         }
@@ -129,15 +318,44 @@ class Database:
             Logger.log_error(f"Error fetching user {user_id}: {e}")
             raise e
 
+    def fetch_subscribers(self, match_ids: list) -> dict:
+        """
+        Fetches the users following each of the matches with their notification
+        state for the match, keyed by match id and then user id
+        """
+        try:
+            subscribers = {match_id: {} for match_id in match_ids}
+            projection = {"matchIds": 1}
+            projection.update(
+                {f"notifications.{match_id}": 1 for match_id in match_ids}
+            )
+            users = self.db.users.find(
+                {"matchIds": {"$in": [str(match_id) for match_id in match_ids]}},
+                projection,
+            )
+            for user in users:
+                notifications = user.get("notifications", {})
+                for match_id in match_ids:
+                    if str(match_id) in user["matchIds"]:
+                        subscribers[match_id][user["_id"]] = notifications.get(
+                            str(match_id), {}
+                        )
+            return subscribers
+        except Exception as e:
+            Logger.log_error(f"Error fetching subscribers of matches {match_ids}: {e}")
+            raise e
+
     def fetch_user_notifications(self, user_id: str, match_id: str) -> dict:
         """
-        Fetches the notifications sent to the user for a specific match
+        Fetches the watermark and the recent timestamps of the notifications sent to
+        the user for a specific match
         """
         try:
-            user_data = self.db.users.find_one({"_id": user_id})
+            user_data = self.db.users.find_one(
+                {"_id": user_id}, {f"notifications.{match_id}": 1}
+            )
             if user_data and "notifications" in user_data:
-                match_notifications = user_data["notifications"].get(match_id, {})
-                return match_notifications.get("sentNotifications", {})
+                return user_data["notifications"].get(match_id, {})
             return {}
         except Exception as e:
             Logger.log_error(
@@ -145,26 +363,33 @@ class Database:
             )
             raise e
 
-    def update_user_notifications(
-        self, user_id: str, match_id: str, notifications: dict, timestamp: int
-    ) -> None:
+    def save_user_notifications(self, updates: dict) -> None:
         """
-        Updates the notifications sent to the user
+        Saves the recent notification timestamps of each user and match and moves
+        their watermark forward, with one bulk write. The hash map of notifications
+        kept by older versions is dropped
         """
         try:
-            self.db.users.update_one(
-                {"_id": user_id},
-                {
-                    "$set": {
-                        f"notifications.{match_id}.sentNotifications": notifications,
-                        f"notifications.{match_id}.lastNotificationSent": timestamp,
-                    }
-                },
-            )
+            operations = []
+            for (user_id, match_id), (recent, timestamp, floor) in updates.items():
+                prefix = f"notifications.{match_id}"
+                operations.append(
+                    UpdateOne(
+                        {"_id": user_id},
+                        {
+                            "$set": {
+                                f"{prefix}.recentNotifications": recent,
+                                f"{prefix}.notificationFloor": floor,
+                            },
+                            "$max": {f"{prefix}.lastNotificationSent": timestamp},
+                            "$unset": {f"{prefix}.sentNotifications": ""},
+                        },
+                    )
+                )
+            if operations:
+                self.db.users.bulk_write(operations, ordered=False)
         except Exception as e:
-            Logger.log_error(
-                f"Error updating notifications for user {user_id} and match {match_id}: {e}"
-            )
+            Logger.log_error(f"Error saving user notifications: {e}")
             raise e
 
     def remove_match_id(self, user_id: str, match_id: str) -> None:
@@ -197,7 +422,7 @@ class Database:
                 {
                     "$set": {
                         f"notifications.{match_id}": {
-                            "sentNotifications": {},
+                            "recentNotifications": [],
                             "lastNotificationSent": -1,
                         }
                     }
@@ -223,7 +448,9 @@ class Database:
         Closes the database connection
         """
         try:
-            self.client.close()
+            if Database.__client is not None:
+                Database.__client.close()
+                Database.__client = None
         except Exception as e:
             Logger.log_error(f"Error closing database connection: {e}")
             raise e
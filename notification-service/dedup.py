@@ -0,0 +1,44 @@
+from bisect import insort
+
+
+class DeliveryWindow:
+    """
+    Remembers which commentary timestamps were delivered for a user and match. It
+    keeps the latest timestamp as a watermark and a bounded window of the most
+    recent ones for balls that arrive out of order, so its size stays constant
+    """
+
+    def __init__(
+        self, size: int, watermark: int = -1, recent: list = None, floor: int = -1
+    ) -> None:
+        self.size = size
+        self.watermark = watermark
+        self.recent = sorted(recent or [])[-size:]
+        self.delivered = set(self.recent)
+        # Timestamps up to the floor are treated as delivered
+        self.floor = floor
+
+    def is_new(self, timestamp: int) -> bool:
+        """
+        Checks if the timestamp was not delivered yet
+        """
+        if timestamp > self.watermark:
+            return True
+        if timestamp in self.delivered:
+            return False
+        return timestamp > self.floor
+
+    def add(self, timestamp: int) -> None:
+        """
+        Records a delivered timestamp, dropping the oldest one if the window is full
+        """
+        if timestamp > self.watermark:
+            self.recent.append(timestamp)
+            self.watermark = timestamp
+        else:
+            insort(self.recent, timestamp)
+        self.delivered.add(timestamp)
+
+        if len(self.recent) > self.size:
+            self.floor = self.recent.pop(0)
+            self.delivered.discard(self.floor)
@@ -0,0 +1,129 @@
+import asyncio
+
+import constants
+from database import Database
+from logger import Logger
+from notifyfetch import NotificationFetcher
+from notifysend import NotificationSender
+
+mongodb = Database.get_instance()
+
+
+class NotificationFanOut:
+    """
+    Keeps the users following each match, fetches and renders every new ball once
+    and delivers it to all of them, each user keeping their own watermark
+    """
+
+    def __init__(
+        self, notif_fetch: NotificationFetcher, notif_send: NotificationSender
+    ) -> None:
+        self.notif_fetch = notif_fetch
+        self.notif_send = notif_send
+        self.subscribers = {}
+
+    def subscribe(self, user_id: str, match_id: int) -> None:
+        """
+        Adds the user to the followers of the match
+        """
+        mongodb.fetch_user(user_id, str(match_id))
+        self.subscribers.setdefault(match_id, set()).add(user_id)
+
+    def load_subscribers(self, match_ids: list) -> None:
+        """
+        Adds the users who follow the matches in the database, loading their
+        notification state in the same read
+        """
+        for match_id, users in mongodb.fetch_subscribers(match_ids).items():
+            for user_id, notifications in users.items():
+                self.notif_send.load_window(user_id, match_id, notifications)
+            self.subscribers.setdefault(match_id, set()).update(users)
+        Logger.log_info(
+            "Delivering to %s users",
+            len(set().union(*self.subscribers.values())),
+        )
+
+    def deliver(
+        self, match_id: int, message: str, timestamp: int, user_ids: set = None
+    ) -> None:
+        """
+        Delivers a rendered ball to the given users, every user following the match
+        by default, printing it once
+        """
+        if user_ids is None:
+            user_ids = self.subscribers.get(match_id, ())
+        delivered = [
+            self.notif_send.notify(user_id, match_id, message, timestamp)
+            for user_id in user_ids
+        ]
+        if any(delivered):
+            print(message)
+
+    async def poll(self, match_id: int) -> None:
+        """
+        Delivers the balls of the match added since the last poll. A single fetch
+        from the oldest watermark covers the users who already got a notification,
+        users without any start from the latest ball
+        """
+        fresh, following = set(), set()
+        for user_id in self.subscribers.get(match_id, ()):
+            if self.notif_send.watermark(user_id, match_id) == -1:
+                fresh.add(user_id)
+            else:
+                following.add(user_id)
+
+        balls = []
+        if following:
+            since = min(
+                self.notif_send.watermark(user_id, match_id) for user_id in following
+            )
+            balls = [
+                ball
+                async for ball in self.notif_fetch.fetch_live_commentary(
+                    match_id, since
+                )
+            ]
+        if fresh and not balls:
+            balls = [
+                ball
+                async for ball in self.notif_fetch.fetch_live_commentary(match_id, -1)
+            ]
+
+        for index, (message, timestamp) in enumerate(balls):
+            latest = index == len(balls) - 1
+            self.deliver(
+                match_id, message, timestamp, following | fresh if latest else following
+            )
+
+    async def run(self, match_id: int) -> None:
+        """
+        Polls the match on its own schedule, delivering its balls in order
+        """
+        while True:
+            Logger.log_info("Fetching commentary for match %s", match_id)
+            try:
+                await self.poll(match_id)
+            except Exception as e:
+                Logger.log_error(f"Error polling commentary for match {match_id}: {e}")
+            await asyncio.sleep(constants.POLL_INTERVAL)
+
+    async def stream(self, match_ids: list) -> None:
+        """
+        Delivers the balls of the matches as they are inserted, polling them instead
+        if the change stream cannot be opened
+        """
+
+        async def catch_up() -> None:
+            for match_id in match_ids:
+                await self.poll(match_id)
+
+        try:
+            async for (
+                match_id,
+                message,
+                timestamp,
+            ) in self.notif_fetch.notify_live_stream(match_ids, catch_up):
+                self.deliver(match_id, message, timestamp)
+        except Exception as e:
+            Logger.log_error(f"Error opening the change stream, polling instead: {e}")
+            await asyncio.gather(*[self.run(match_id) for match_id in match_ids])
@@ -3,13 +3,17 @@ import time
 
 import constants
 from environment import Environment
+from fanout import NotificationFanOut
 from logger import Logger
 from menu import Menu
 from notifyfetch import NotificationFetcher
 from notifysend import NotificationSender
 
 # Create a logger instance
-Logger(constants.LOG_FILE)
+Logger(constants.LOG_FILE, constants.LOG_JSON, constants.LOG_LEVEL)
+Logger.configure_payload_logging(
+    constants.PAYLOAD_LOG_MAX_CHARS, constants.PAYLOAD_LOG_SAMPLE_RATE
+)
 Logger.log_info(f"Starting execution for notification service...")
 Logger.log_info(f"Logger setup success for file {constants.LOG_FILE}...")
 
@@ -31,28 +35,37 @@ async def main() -> None:
     action, match_ids = menu.menu()
     Logger.log_info(f"User action: {action} with match IDs: {match_ids}")
 
-    if action == "NON_ACTIVE_MATCHES":
-
-        for match_id in match_ids:
-            async for (
-                message,
-                timestamp,
-            ) in notif_fetch.notify_fetch_full_commentary(user, match_id):
-                notif_send.notify(user, match_id, message, timestamp)
-                await asyncio.sleep(1)
-            Logger.log_info(f"Fetching commentary for matches: {match_ids}")
-        print("Finished fetching commentary for past matches")
-    elif action == "ACTIVE_MATCHES":
-        while True:
-            Logger.log_info(f"Fetching commentary for matches: {match_ids}")
+    flusher = asyncio.create_task(notif_send.flush_periodically())
+    try:
+        if action == "NON_ACTIVE_MATCHES":
+
             for match_id in match_ids:
                 async for (
                     message,
                     timestamp,
-                ) in notif_fetch.notify_live_fetch(user, match_id):
-                    notif_send.notify(user, match_id, message, timestamp)
+                ) in notif_fetch.notify_fetch_full_commentary(user, match_id):
+                    if notif_send.notify(user, match_id, message, timestamp):
+                        print(message)
+                    await asyncio.sleep(1)
+                Logger.log_info(f"Fetching commentary for matches: {match_ids}")
+            print("Finished fetching commentary for past matches")
+        elif action == "ACTIVE_MATCHES":
+            fan_out = NotificationFanOut(notif_fetch, notif_send)
+            for match_id in match_ids:
+                fan_out.subscribe(user, match_id)
+            fan_out.load_subscribers(match_ids)
 
-            await asyncio.sleep(constants.POLL_INTERVAL)
+            if notif_fetch.supports_live_stream():
+                Logger.log_info(f"Streaming commentary for matches: {match_ids}")
+                await fan_out.stream(match_ids)
+            else:
+                Logger.log_info("Change streams are not available, polling instead")
+                await asyncio.gather(*[fan_out.run(match_id) for match_id in match_ids])
+    finally:
+        flusher.cancel()
+        # Save the notifications still held in memory
+        notif_send.flush()
+        notif_fetch.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
 from database import Database
 
-mongodb = Database()
+mongodb = Database.get_instance()
 
 
 class Menu:
@@ -1,9 +1,14 @@
-from typing import AsyncGenerator, Tuple
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncGenerator, Awaitable, Callable, Tuple
+
+import constants
 
 from database import Database
 from logger import Logger
 
-mongodb = Database()
+mongodb = Database.get_instance()
 
 
 class NotificationFetcher:
@@ -14,35 +19,100 @@ class NotificationFetcher:
     def __init__(self) -> None:
         self.active_match_ids = mongodb.fetch_active_match_ids() or {}
         self.non_active_match_ids = mongodb.fetch_non_active_match_ids() or {}
-
-    async def notify_live_fetch(
-        self, user_id: str, match_id_int: int
-    ) -> AsyncGenerator[Tuple[str, str], None]:
+        # Rendered match header and the header fields it was built from, per match
+        self.headers = {}
+        # Threads shared by the matches for their blocking database reads
+        self.db_pool = ThreadPoolExecutor(constants.DB_WORKERS)
+
+    async def fetch_live_commentary(
+        self, match_id: int, timestamp: int
+    ) -> AsyncGenerator[Tuple[str, int], None]:
         """
-        Notifies the users about the latest commentary for a specific match
+        Fetches the commentary of a match newer than the timestamp, rendering each
+        ball once for all the users who follow the match
         """
-        match_id = str(match_id_int)
-        user = mongodb.fetch_user(user_id, match_id)
-        Logger.log_info(f"Fetching user data for {user_id}: {user}")
+        if timestamp == -1:
+            # Nothing sent yet, start from the latest ball
+            commentary = await self._run_db(
+                mongodb.fetch_commentary_since, str(match_id), -1, limit=1
+            )
+        else:
+            commentary = await self._run_db(
+                mongodb.fetch_commentary_since, str(match_id), timestamp
+            )
+        header = self._render_header(
+            match_id, await self._run_db(mongodb.fetch_match_header, int(match_id))
+        )
+        Logger.log_payload("Fetching commentary for %s", commentary, match_id)
+
+        for comment in commentary:
+            message = self._parse_cricket_commentary(comment, header)
+            timestamp = comment["timestamp"]
+            yield message, timestamp
 
-        last_notif_timestamp = user["notifications"][match_id]["lastNotificationSent"]
-        commentary = await self._fetch_commentary_match(match_id, last_notif_timestamp)
-        match_header = mongodb.fetch_match_header(int(match_id))
-        Logger.log_info(f"Fetching commentary for {match_id}: {commentary}")
+    async def _run_db(self, func, *args, **kwargs):
+        """
+        Runs a blocking database call in the shared pool, so a slow read only holds
+        up its own match
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_pool, partial(func, *args, **kwargs))
 
-        if user["notifications"][match_id]["lastNotificationSent"] == -1:
-            message = self._parse_cricket_commentary(commentary[0], match_header)
-            timestamp = commentary[0]["timestamp"]
-            yield message, timestamp
+    def close(self) -> None:
+        """
+        Shuts the database pool down
+        """
+        self.db_pool.shutdown(wait=False)
 
-        for comment in reversed(commentary):
-            if (
-                comment["timestamp"]
-                > user["notifications"][match_id]["lastNotificationSent"]
-            ):
-                message = self._parse_cricket_commentary(comment, match_header)
-                timestamp = comment["timestamp"]
-                yield message, timestamp
+    def supports_live_stream(self) -> bool:
+        """
+        Checks if live commentary can be pushed through change streams
+        """
+        return (
+            constants.LIVE_DELIVERY == "change_stream"
+            and constants.COMMENTARY_STORAGE_MODE == "ball"
+            and mongodb.supports_change_streams()
+        )
+
+    async def notify_live_stream(
+        self, match_ids: list, catch_up: Callable[[], Awaitable[None]]
+    ) -> AsyncGenerator[Tuple[int, str, int], None]:
+        """
+        Notifies the users about the commentary of the matches as it is inserted,
+        yields the match id, the message and the timestamp. Catch up is awaited every
+        time the stream is opened, to deliver what was inserted before. A failed
+        stream is reopened from the last saved token, errors opening it are raised
+        """
+        token_key = "notifier:live"
+        while True:
+            resume_token = await self._run_db(mongodb.fetch_resume_token, token_key)
+            stream = await self._run_db(
+                mongodb.watch_commentary, match_ids, resume_token
+            )
+            try:
+                with stream:
+                    await catch_up()
+                    while stream.alive:
+                        change = await self._run_db(stream.try_next)
+                        if change is None:
+                            continue
+                        await self._run_db(
+                            mongodb.save_resume_token, token_key, stream.resume_token
+                        )
+
+                        comment = change["fullDocument"]
+                        match_id = comment["matchId"]
+                        # Re-rendered only when the stored header changed
+                        header = self._render_header(
+                            match_id,
+                            await self._run_db(mongodb.fetch_match_header, match_id),
+                        )
+                        message = self._parse_cricket_commentary(comment, header)
+                        yield match_id, message, comment["timestamp"]
+            except Exception as e:
+                Logger.log_error(f"Error in the commentary change stream: {e}")
+                await asyncio.sleep(constants.POLL_INTERVAL)
+            Logger.log_info("Reopening the commentary change stream")
 
     async def notify_fetch_full_commentary(
         self, user_id: str, match_id_int: int
@@ -52,61 +122,71 @@ class NotificationFetcher:
         """
         match_id = str(match_id_int)
         user = mongodb.fetch_user(user_id, match_id)
-        Logger.log_info(f"Fetching user data for {user_id}: {user}")
+        Logger.log_payload("Fetching user data for %s", user, user_id)
 
-        commentary = await self._fetch_commentary_match(match_id, 0)
-        match_header = mongodb.fetch_match_header(int(match_id))
+        header = self._render_header(
+            match_id_int, mongodb.fetch_match_header(int(match_id))
+        )
         Logger.log_info(f"Fetching commentary for {match_id}")
 
-        for comment in reversed(commentary):
-            message = self._parse_cricket_commentary(comment, match_header)
+        for comment in mongodb.iter_commentary(match_id):
+            message = self._parse_cricket_commentary(comment, header)
             timestamp = comment["timestamp"]
             yield message, timestamp
 
-    async def _fetch_commentary_match(self, match_id: str, timestamp: int) -> list:
+    def _render_header(self, match_id: int, match_header: dict) -> str:
         """
-        Fetches the latest commentary for the match
+        Returns the match part of the notifications, built once per version of the
+        match header
         """
-        commentary = mongodb.fetch_commentary(match_id)
-        commentary.sort(key=lambda x: x["timestamp"] > timestamp, reverse=True)
-        return commentary
-
-    def _parse_cricket_commentary(self, commentary: dict, match_header: dict) -> str:
+        toss_results = match_header["tossResults"]
+        version = (
+            match_header["matchDescription"],
+            match_header["matchFormat"],
+            match_header["matchType"],
+            match_header["seriesName"],
+            match_header["team1"]["shortName"],
+            match_header["team2"]["shortName"],
+            toss_results["tossWinnerName"],
+            toss_results["decision"],
+        )
+        cached = self.headers.get(match_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        header = f"""
+        Match Description: {version[0]}
+        Match Format: {version[1]}
+        Match Type: {version[2]}
+        Series: {version[3]}
+        Game: {version[4]} vs {version[5]}
+        Toss Result: {version[6]} won the toss and chose to {version[7].lower()}.
+"""
+        self.headers[match_id] = (version, header)
+        return header
+
+    def _parse_cricket_commentary(self, commentary: dict, header: str) -> str:
         """
         Parses the cricket commentary and returns a clean string
         """
-        ball_number = commentary.get("ballNbr", "")
-        over_number = commentary.get("overNumber", "")
-        innings = commentary.get("inningsId", "")
-        batting_team = commentary.get("batTeamName", "")
-        batting_score = commentary.get("batTeamScore", "")
-
-        match_info = f"""
-        Match Description: {match_header['matchDescription']}
-        Match Format: {match_header['matchFormat']}
-        Match Type: {match_header['matchType']}
-        Series: {match_header['seriesName']}
-        Game: {match_header['team1']['shortName']} vs {match_header['team2']['shortName']}
-        Toss Result: {match_header['tossResults']['tossWinnerName']} won the toss and chose to {match_header['tossResults']['decision'].lower()}.
-        Innings: {innings}
-        Over Number: {over_number}
-        Ball Number: {ball_number}
-        Batting Team: {batting_team}
-        Batting Score: {batting_score}
-        Commentary: {commentary['commText']}
-        """
-        return self._format_commentary(match_info, commentary)
-
-    def _format_commentary(self, formatted_text: str, commentary: dict) -> str:
-        if (
-            "commentaryFormats" in commentary
-            and "bold" in commentary["commentaryFormats"]
-        ):
-            format_ids = commentary["commentaryFormats"]["bold"]["formatId"]
-            format_values = commentary["commentaryFormats"]["bold"]["formatValue"]
-
-            # Replace formatId with formatValue
-            for i in range(len(format_ids)):
-                formatted_text = formatted_text.replace(format_ids[i], format_values[i])
-
-        return formatted_text
+        return (
+            f"{header}"
+            f"        Innings: {commentary.get('inningsId', '')}\n"
+            f"        Over Number: {commentary.get('overNumber', '')}\n"
+            f"        Ball Number: {commentary.get('ballNbr', '')}\n"
+            f"        Batting Team: {commentary.get('batTeamName', '')}\n"
+            f"        Batting Score: {commentary.get('batTeamScore', '')}\n"
+            f"        Commentary: {self._format_commentary(commentary)}\n"
+            "        "
+        )
+
+    def _format_commentary(self, commentary: dict) -> str:
+        """
+        Replaces the format ids in the commentary text with their values
+        """
+        text = commentary["commText"]
+        bold = commentary.get("commentaryFormats", {}).get("bold")
+        if bold:
+            for format_id, format_value in zip(bold["formatId"], bold["formatValue"]):
+                text = text.replace(format_id, format_value)
+        return text
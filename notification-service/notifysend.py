@@ -1,48 +1,140 @@
-import hashlib
+import asyncio
+import time
 
+import constants
 from database import Database
+from dedup import DeliveryWindow
 from filehandler import Filehandler
+from logger import Logger
 
-mongodb = Database()
+mongodb = Database.get_instance()
 
 
 class NotificationSender:
+    def __init__(self) -> None:
+        # Delivered timestamps per (user, match), loaded once and kept in memory
+        self.windows = {}
+        # (user, match) pairs with deliveries since the last flush
+        self.pending = set()
+        self.pending_count = 0
+        self.pending_since = None
+
     def clear_all_sent_notifications(self, user_id: str) -> None:
         mongodb.clear_match_ids(user_id)
+        for key in [key for key in self.windows if key[0] == user_id]:
+            del self.windows[key]
+            self.pending.discard(key)
+
+    def notify(self, user_id: str, match_id: str, message: str, timestamp: int) -> bool:
+        """
+        Notifies the user, returns whether the notification was new to them
+        """
+        match_id = str(match_id)
+        window = self._delivery_window(user_id, match_id)
+        if not window.is_new(timestamp):
+            return False
+
+        file = Filehandler.get_instance(user_id)
+        file.append_to_file(message)
+        window.add(timestamp)
+        self._add_pending(user_id, match_id)
+        return True
 
-    def notify(self, user_id: str, match_id: str, message: str, timestamp: int) -> None:
+    def watermark(self, user_id: str, match_id: str) -> int:
         """
-        Notifies the user
+        Returns the timestamp of the latest notification sent to the user for the
+        match
         """
-        unique, notifications = self._check_notification_unique(
-            user_id, match_id, timestamp
+        return self._delivery_window(user_id, str(match_id)).watermark
+
+    def flush(self) -> None:
+        """
+        Writes the notifications sent since the last flush
+        """
+        if not self.pending:
+            return
+        Logger.log_info("Saving %s sent notifications", self.pending_count)
+        mongodb.save_user_notifications(
+            {
+                key: (
+                    self.windows[key].recent,
+                    self.windows[key].watermark,
+                    self.windows[key].floor,
+                )
+                for key in self.pending
+            }
         )
-        if unique:
-            file = Filehandler.get_instance(user_id)
-            file.append_to_file(message)
-            print(message)
-            notification_hash = self._generate_hash(user_id, match_id, timestamp)
-            notifications[notification_hash] = timestamp
-            mongodb.update_user_notifications(
-                user_id, match_id, notifications, timestamp
+        self.pending = set()
+        self.pending_count = 0
+        self.pending_since = None
+
+    def _delivery_window(self, user_id: str, match_id: str) -> DeliveryWindow:
+        """
+        Returns the timestamps delivered to the user for the match
+        """
+        key = (user_id, match_id)
+        if key not in self.windows:
+            self.load_window(
+                user_id, match_id, mongodb.fetch_user_notifications(user_id, match_id)
             )
+        return self.windows[key]
+
+    def load_window(self, user_id: str, match_id: str, notifications: dict) -> None:
+        """
+        Sets up the delivered timestamps of the user for the match from their saved
+        notification state, unless they are already loaded
+        """
+        key = (user_id, str(match_id))
+        if key in self.windows:
+            return
+
+        watermark = notifications.get("lastNotificationSent", -1)
+        if "recentNotifications" in notifications:
+            floor = notifications.get("notificationFloor", -1)
+        else:
+            # Saved before the window existed, everything up to the watermark was
+            # delivered
+            floor = watermark
+        self.windows[key] = DeliveryWindow(
+            constants.NOTIFICATION_DEDUP_WINDOW,
+            watermark,
+            notifications.get("recentNotifications", []),
+            floor,
+        )
+
+    def _add_pending(self, user_id: str, match_id: str) -> None:
+        """
+        Records a sent notification and flushes once enough have piled up
+        """
+        self.pending.add((user_id, match_id))
+        self.pending_count += 1
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+
+        if self.pending_count >= constants.NOTIFICATION_FLUSH_SIZE:
+            self.flush()
+        else:
+            self.flush_if_due()
 
-    def _check_notification_unique(
-        self, user_id: str, match_id: str, timestamp: int
-    ) -> tuple:
+    def flush_if_due(self) -> None:
         """
-        Checks if a notification is unique in the user's notifications
+        Flushes once the oldest pending notification is old enough
         """
-        notifications = mongodb.fetch_user_notifications(user_id, match_id)
-        notification_hash = self._generate_hash(user_id, match_id, timestamp)
-        if notification_hash not in notifications:
-            return True, notifications
-        return False, notifications
+        if (
+            self.pending_since is not None
+            and time.monotonic() - self.pending_since
+            >= constants.NOTIFICATION_FLUSH_INTERVAL
+        ):
+            self.flush()
 
-    def _generate_hash(self, user_id: str, match_id: str, timestamp: int) -> str:
+    async def flush_periodically(self) -> None:
         """
-        Generates a SHA-256 hash for the notification
+        Flushes the pending notifications on time even when no more balls arrive
         """
-        data = f"{user_id}-{match_id}-{timestamp}"
-        hash_object = hashlib.sha256(data.encode())
-        return hash_object.hexdigest()
+        while True:
+            await asyncio.sleep(constants.NOTIFICATION_FLUSH_INTERVAL)
+            try:
+                self.flush_if_due()
+            except Exception as e:
+                # The pending notifications are kept for the next attempt
+                Logger.log_error(f"Error flushing sent notifications: {e}")